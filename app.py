@@ -1,9 +1,12 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse
-import db
+from fastapi.responses import JSONResponse, StreamingResponse
+import async_db
+import asyncio
 import os
+import lobby_events
+import http_cache
 from typing import Optional
 
 app = FastAPI()
@@ -26,11 +29,10 @@ templates = Jinja2Templates(directory=templates_path)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
-@app.get("/api/user/{user_id}")
-async def get_user_data(user_id: int):
-    user = db.get_user(user_id)
+async def _user_payload(user_id):
+    user = await async_db.get_user(user_id)
     if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+        return None
     
     # game_id, nickname, elo, level, matches, wins
     return {
@@ -42,49 +44,128 @@ async def get_user_data(user_id: int):
         "wins": user[5]
     }
 
-@app.get("/api/leaderboard")
-async def get_leaderboard():
-    users = db.get_all_users()
-    # Sort by ELO descending
-    sorted_users = sorted(users, key=lambda x: x[3], reverse=True)
+@app.get("/api/user/{user_id}")
+async def get_user_data(request: Request, user_id: int):
+    import state
+    version = await state.get_cache_version(state.PROFILE_VERSIONS_KEY, user_id)
+
+    async def build():
+        payload = await _user_payload(user_id)
+        if payload is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return payload
+
+    return await http_cache.respond(request, ("user", user_id), version, build)
+
+# Сколько игроков показывает вкладка рейтинга
+LEADERBOARD_TOP = 50
+
+async def _leaderboard_payload(limit=LEADERBOARD_TOP):
+    import state
+    top = await state.get_leaderboard_top(limit)
     
     leaderboard = []
-    for u in sorted_users[:50]: # Top 50
+    for p in top:
         leaderboard.append({
-            "user_id": u[0],
-            "nickname": u[2],
-            "elo": u[3],
-            "level": u[4]
+            "user_id": p["user_id"],
+            "nickname": p["nickname"],
+            "elo": p["elo"],
+            "level": async_db.get_level_by_elo(p["elo"])
         })
     return leaderboard
 
+@app.get("/api/leaderboard")
+async def get_leaderboard(request: Request):
+    import state
+    version = await state.get_cache_version(state.LEADERBOARD_VERSION_KEY)
+    return await http_cache.respond(request, ("leaderboard",), version, _leaderboard_payload)
+
+@app.get("/api/leaderboard/{user_id}")
+async def get_leaderboard_position(user_id: int, radius: int = 2):
+    # Место игрока и соседи по рейтингу
+    import state
+    radius = max(0, min(radius, 10))
+    rank = await state.get_leaderboard_rank(user_id)
+    if not rank:
+        raise HTTPException(status_code=404, detail="User not ranked")
+    around = await state.get_leaderboard_around(user_id, radius)
+    return {
+        "rank": rank["rank"],
+        "elo": rank["elo"],
+        "around": [
+            {**p, "level": async_db.get_level_by_elo(p["elo"])} for p in around
+        ]
+    }
+
+async def _lobbies_payload(user_id, since, version):
+    import core
+
+    if since is not None:
+        # Дельта: только лобби, изменившиеся после версии клиента (один Lua-скрипт)
+        delta = await core.get_changes(user_id, since)
+        if delta is not None:
+            return delta
+
+    result = await core.get_snapshot(user_id)
+    return {"version": version, **result}
+
 @app.get("/api/lobbies/{user_id}")
-async def get_lobbies(user_id: int):
+async def get_lobbies(request: Request, user_id: int, since: Optional[int] = None):
     import state
-    lobby_players = state.lobby_players
-    
-    # Проверяем, в каком лобби сейчас пользователь
-    user_current_lobby = None
-    for mode in ["1x1", "2x2", "5x5"]:
-        for lid in range(1, 11):
-            if user_id in lobby_players[mode][lid]:
-                user_current_lobby = {"mode": mode, "id": lid}
-                break
-        if user_current_lobby: break
-
-    result = {"modes": {}, "user_lobby": user_current_lobby}
-    for mode in ["1x1", "2x2", "5x5"]:
-        result["modes"][mode] = []
-        for lid in range(1, 11):
-            players = lobby_players[mode][lid]
-            max_p = 2 if mode == "1x1" else (4 if mode == "2x2" else 10)
-            result["modes"][mode].append({
-                "id": lid,
-                "players": len(players),
-                "max": max_p,
-                "is_user_here": user_id in players
-            })
-    return result
+    # Версию читаем до снимка: данные не старше версии, лишнее изменение клиент просто получит повторно
+    epoch, version = await state.get_cache_version(state.LOBBY_VERSION_KEY)
+    return await http_cache.respond(
+        request, ("lobbies", user_id, since), (epoch, version),
+        lambda: _lobbies_payload(user_id, since, version)
+    )
+
+@app.get("/api/bootstrap/{user_id}")
+async def bootstrap(user_id: int, top: int = LEADERBOARD_TOP):
+    # Все данные для открытия Mini App одним запросом: профиль, лобби и топ рейтинга собираются параллельно
+    import state
+    top = max(1, min(top, LEADERBOARD_TOP))
+    lobby_version = await state.get_lobby_version()
+    user, lobbies, leaderboard = await asyncio.gather(
+        _user_payload(user_id),
+        _lobbies_payload(user_id, None, lobby_version),
+        _leaderboard_payload(top)
+    )
+    return {"user": user, "lobbies": lobbies, "leaderboard": leaderboard}
+
+# Как часто отправлять комментарий-пинг, чтобы прокси не закрывали тихий поток
+LOBBY_STREAM_KEEPALIVE = 15
+
+@app.get("/api/lobbies/{user_id}/stream")
+async def stream_lobbies(user_id: int):
+    # Server-Sent Events: первый снимок сразу, дальше - при каждом изменении лобби
+    import state
+    subscription = lobby_events.subscribe()
+
+    async def events():
+        try:
+            version = await state.get_lobby_version()
+            snapshot = await state.get_lobbies_snapshot(with_players=True)
+            yield lobby_events.format_event(lobby_events.user_view(snapshot, user_id, version))
+            while True:
+                update = await subscription.wait(LOBBY_STREAM_KEEPALIVE)
+                if subscription.closed:
+                    break
+                if update is None:
+                    yield ": ping\n\n"
+                else:
+                    version, snapshot = update
+                    yield lobby_events.format_event(lobby_events.user_view(snapshot, user_id, version))
+        finally:
+            lobby_events.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Открытые потоки не должны держать остановку uvicorn
+app.router.add_event_handler("shutdown", lobby_events.close)
 
 @app.post("/api/user/update")
 async def update_user(data: dict):
@@ -92,22 +173,26 @@ async def update_user(data: dict):
     nickname = data.get("nickname")
     game_id = data.get("game_id")
     
-    import db
-    db.update_user_profile(user_id, nickname=nickname, game_id=game_id)
+    await async_db.update_user_profile(user_id, nickname=nickname, game_id=game_id)
     return {"status": "success"}
 
 @app.post("/api/lobby/enter")
 async def enter_lobby(data: dict):
-    user_id = data.get("user_id")
+    try:
+        user_id = int(data.get("user_id"))
+        lobby_id = int(data.get("lobby_id"))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid lobby request")
     mode = data.get("mode")
-    lobby_id = data.get("lobby_id")
     
     import core
-    # Try to join
+    # Тот же сервис, что и у кнопок бота: экраны в Telegram обновятся, полное лобби соберет матч
     result = await core.join_lobby(user_id, mode, lobby_id)
+    if result["status"] == "error" and result["message"] == "Banned":
+        raise HTTPException(status_code=403, detail="Banned")
     
     if result["status"] == "error" and result["message"] == "Already in lobby":
-        # If already in, then leave (toggle behavior)
+        # Повторное нажатие - выход (переключатель)
         result = await core.leave_lobby(user_id, mode, lobby_id)
         
     return result
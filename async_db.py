@@ -0,0 +1,205 @@
+"""Асинхронная обертка над db.py.
+
+Все запросы SQLite выполняются вне event loop, чтобы медленная запись
+не останавливала polling ботов и FastAPI. Записи идут через один поток
+(SQLite все равно допускает только одного писателя, а очередь сохраняет
+порядок), чтения - через пул потоков с соединениями только для чтения.
+
+Использование: `import async_db` и `await async_db.get_user(user_id)` -
+сигнатуры те же, что в db.py.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+READER_THREADS = int(os.getenv("DB_READER_THREADS", 4))
+
+_writer = None
+_readers = None
+
+def _init_reader():
+    db.get_connection(read_only=True)
+
+def _init_writer():
+    db.get_connection()
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer", initializer=_init_writer)
+    return _writer
+
+def _get_readers():
+    global _readers
+    if _readers is None:
+        _readers = ThreadPoolExecutor(max_workers=READER_THREADS, thread_name_prefix="db-reader", initializer=_init_reader)
+    return _readers
+
+async def _read(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_readers(), lambda: func(*args, **kwargs))
+
+async def _write(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_writer(), lambda: func(*args, **kwargs))
+
+def shutdown():
+    global _writer, _readers
+    for executor in (_writer, _readers):
+        if executor is not None:
+            executor.shutdown(wait=True)
+    _writer = _readers = None
+    db.close_connections()
+
+async def _write_with_entries(user_ids, func, *args, **kwargs):
+    # Запись и чтение строк лидерборда одной задачей писателя: в зеркало уходят
+    # значения, записанные этим вызовом, а не прочитанные позже через пул читателей,
+    # куда успела бы вклиниться следующая запись. Если func вернула False
+    # (ничего не изменилось), строки не читаем
+    def call():
+        result = func(*args, **kwargs)
+        entries = db.get_leaderboard_entries(user_ids) if result is not False else []
+        return result, entries
+    return await _write(call)
+
+async def _sync_leaderboard(user_ids, entries):
+    # Обновляем Redis-зеркало лидерборда после изменения ELO или никнейма.
+    # Ошибка Redis не должна откатывать уже записанные в SQLite данные
+    import state
+    try:
+        await state.update_leaderboard(entries)
+    except Exception as e:
+        logging.error(f"Failed to sync leaderboard for {user_ids}: {e}")
+
+async def _touch_profiles(user_ids):
+    # Новая версия профиля - ETag и кэш /api/user/{user_id} перестают совпадать
+    import state
+    try:
+        await state.bump_profile_versions(user_ids)
+    except Exception as e:
+        logging.error(f"Failed to bump profile versions for {user_ids}: {e}")
+
+async def rebuild_leaderboard():
+    # Полная пересборка зеркала лидерборда из SQLite
+    import state
+    entries = await _read(db.get_leaderboard_entries)
+    await state.replace_leaderboard(entries)
+    return len(entries)
+
+# Чистые функции без обращения к БД
+get_level_by_elo = db.get_level_by_elo
+
+async def init_db():
+    return await _write(db.init_db)
+
+# Чтение
+async def get_all_users():
+    return await _read(db.get_all_users)
+
+async def get_users_page(after_id=0, before_id=None, limit=10):
+    return await _read(db.get_users_page, after_id, before_id, limit)
+
+async def count_users():
+    return await _read(db.count_users)
+
+async def get_user(user_id):
+    return await _read(db.get_user, user_id)
+
+async def get_ban_status(user_id):
+    return await _read(db.get_ban_status, user_id)
+
+async def get_top_players(limit=10):
+    return await _read(db.get_top_players, limit)
+
+async def get_match_players(match_id):
+    return await _read(db.get_match_players, match_id)
+
+async def get_pending_match(match_id):
+    return await _read(db.get_pending_match, match_id)
+
+async def get_support_ticket(ticket_id):
+    return await _read(db.get_support_ticket, ticket_id)
+
+async def get_all_tickets():
+    return await _read(db.get_all_tickets)
+
+async def get_all_lobby_members():
+    return await _read(db.get_all_lobby_members)
+
+async def get_user_by_nickname(nickname):
+    return await _read(db.get_user_by_nickname, nickname)
+
+async def get_user_by_game_id(game_id):
+    return await _read(db.get_user_by_game_id, game_id)
+
+# Запись
+async def add_user(user_id, game_id, nickname):
+    _, entries = await _write_with_entries([user_id], db.add_user, user_id, game_id, nickname)
+    await _sync_leaderboard([user_id], entries)
+    await _touch_profiles([user_id])
+
+async def update_user_profile(user_id, nickname=None, game_id=None):
+    if nickname:
+        _, entries = await _write_with_entries([user_id], db.update_user_profile, user_id, nickname=nickname, game_id=game_id)
+        await _sync_leaderboard([user_id], entries)
+    else:
+        await _write(db.update_user_profile, user_id, nickname=nickname, game_id=game_id)
+    await _touch_profiles([user_id])
+
+async def increment_missed_games(user_id):
+    return await _write(db.increment_missed_games, user_id)
+
+async def reset_missed_games(user_id):
+    return await _write(db.reset_missed_games, user_id)
+
+async def set_ban_status(user_id, status, until=None):
+    return await _write(db.set_ban_status, user_id, status, until)
+
+async def create_match(mode, players_ids):
+    return await _write(db.create_match, mode, players_ids)
+
+async def accept_match_player(match_id, user_id):
+    return await _write(db.accept_match_player, match_id, user_id)
+
+async def cancel_match(match_id):
+    return await _write(db.cancel_match, match_id)
+
+async def update_elo(user_id, elo_change, is_win):
+    _, entries = await _write_with_entries([user_id], db.update_elo, user_id, elo_change, is_win)
+    await _sync_leaderboard([user_id], entries)
+    await _touch_profiles([user_id])
+
+async def settle_match(match_id, winners, losers, delta):
+    user_ids = list(winners) + list(losers)
+    settled, entries = await _write_with_entries(user_ids, db.settle_match, match_id, winners, losers, delta)
+    if settled:
+        await _sync_leaderboard(user_ids, entries)
+        await _touch_profiles(user_ids)
+    return settled
+
+async def manual_update_elo(user_id, elo_change):
+    _, entries = await _write_with_entries([user_id], db.manual_update_elo, user_id, elo_change)
+    await _sync_leaderboard([user_id], entries)
+    await _touch_profiles([user_id])
+
+async def adjust_user_stats(user_id, matches_change, wins_change):
+    await _write(db.adjust_user_stats, user_id, matches_change, wins_change)
+    await _touch_profiles([user_id])
+
+async def create_support_ticket(user_id, text):
+    return await _write(db.create_support_ticket, user_id, text)
+
+async def update_support_ticket(ticket_id, admin_id=None, status=None):
+    return await _write(db.update_support_ticket, ticket_id, admin_id=admin_id, status=status)
+
+async def close_ticket(ticket_id, admin_id):
+    return await _write(db.close_ticket, ticket_id, admin_id)
+
+async def add_lobby_member(mode, lobby_id, user_id):
+    return await _write(db.add_lobby_member, mode, lobby_id, user_id)
+
+async def remove_lobby_member(user_id):
+    return await _write(db.remove_lobby_member, user_id)
@@ -0,0 +1,46 @@
+import os
+import time
+from datetime import datetime
+
+import async_db
+
+BAN_CACHE_TTL = float(os.getenv("BAN_CACHE_TTL", 15))
+BAN_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# user_id -> (момент истечения записи, (is_banned, ban_until))
+_cache = {}
+
+def invalidate(user_id=None):
+    if user_id is None:
+        _cache.clear()
+    else:
+        _cache.pop(user_id, None)
+
+async def _load(user_id):
+    now = time.monotonic()
+    entry = _cache.get(user_id)
+    if entry and entry[0] > now:
+        return entry[1]
+    row = await async_db.get_ban_status(user_id)
+    status = (bool(row[0]), row[1]) if row else (False, None)
+    _cache[user_id] = (now + BAN_CACHE_TTL, status)
+    return status
+
+async def get_active_ban(user_id):
+    """Возвращает (True, ban_until) для действующего бана, иначе (False, None).
+
+    ban_until = None означает бан навсегда. Истекший временный бан снимается здесь же.
+    """
+    banned, ban_until = await _load(user_id)
+    if not banned:
+        return False, None
+    if ban_until:
+        if datetime.now() >= datetime.strptime(ban_until, BAN_TIME_FORMAT):
+            # Время бана истекло
+            await set_ban_status(user_id, False)
+            return False, None
+    return True, ban_until
+
+async def set_ban_status(user_id, status, until=None):
+    await async_db.set_ban_status(user_id, status, until)
+    invalidate(user_id)
@@ -0,0 +1,69 @@
+"""Бенчмарк проверки бана: полный get_all_users() против точечного запроса и кэша.
+
+Запуск: python benchmarks/bench_bans.py [кол-во пользователей]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_db
+import bans
+import db
+
+def legacy_check(user_id):
+    # Так проверяли бан в каждом хендлере раньше
+    all_users = db.get_all_users()
+    user_db_data = next((u for u in all_users if u[0] == user_id), None)
+    return bool(user_db_data and user_db_data[5] == 1)
+
+def report(name, ops, elapsed):
+    print(f"{name:<28} {ops:>7} проверок  {elapsed * 1000 / ops:9.3f} мс/проверка  {ops / elapsed:>10.0f} ops/s")
+
+async def run_async(user_ids):
+    start = time.perf_counter()
+    for uid in user_ids:
+        await async_db.get_ban_status(uid)
+    report("get_ban_status (async_db)", len(user_ids), time.perf_counter() - start)
+
+    bans.invalidate()
+    start = time.perf_counter()
+    for uid in user_ids:
+        await bans.get_active_ban(uid)
+    report("bans.get_active_ban", len(user_ids), time.perf_counter() - start)
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.init_db()
+        with db.get_connection() as conn:
+            conn.executemany(
+                'INSERT INTO users (user_id, game_id, nickname, is_banned) VALUES (?, ?, ?, ?)',
+                ((uid, str(10000000 + uid), f"player{uid}", 1 if uid % 100 == 0 else 0) for uid in range(1, users + 1))
+            )
+
+        # Горячий набор: активные игроки кликают много раз подряд
+        hot = [random.randint(1, users) for _ in range(200)]
+        sample = [random.choice(hot) for _ in range(5000)]
+
+        legacy_ops = 20
+        start = time.perf_counter()
+        for uid in sample[:legacy_ops]:
+            legacy_check(uid)
+        report("get_all_users + next()", legacy_ops, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for uid in sample:
+            db.get_ban_status(uid)
+        report("db.get_ban_status", len(sample), time.perf_counter() - start)
+
+        asyncio.run(run_async(sample))
+        async_db.shutdown()
+
+if __name__ == "__main__":
+    main()
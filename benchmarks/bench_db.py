@@ -0,0 +1,81 @@
+"""Бенчмарк слоя БД: соединение на каждый вызов против постоянного соединения.
+
+Запуск: python benchmarks/bench_db.py [кол-во операций]
+Работает на временной копии базы, рабочий database.db не трогает.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+USERS = 1000
+
+def legacy_get_user(path, user_id):
+    # Так db.py работал раньше: connect/close на каждый запрос
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT game_id, nickname, elo, level, matches, wins FROM users WHERE user_id = ?', (user_id,))
+    user = cursor.fetchone()
+    conn.close()
+    return user
+
+def legacy_lobby_toggle(path, user_id):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR REPLACE INTO lobby_members (mode, lobby_id, user_id) VALUES (?, ?, ?)', ("2x2", 1, user_id))
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM lobby_members WHERE user_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+
+def pooled_lobby_toggle(user_id):
+    db.add_lobby_member("2x2", 1, user_id)
+    db.remove_lobby_member(user_id)
+
+def measure(name, fn, ops):
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i % USERS + 1)
+    elapsed = time.perf_counter() - start
+    rate = ops / elapsed
+    print(f"{name:<32} {ops:>7} ops  {elapsed:8.3f}s  {rate:>10.0f} ops/s")
+    return rate
+
+def main():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        pooled_path = os.path.join(tmp, "pooled.db")
+
+        for path in (legacy_path, pooled_path):
+            db.close_connections()
+            db.DB_PATH = path
+            db.init_db()
+            for uid in range(1, USERS + 1):
+                db.add_user(uid, str(10000000 + uid), f"player{uid}")
+        db.close_connections()
+
+        # "До": журнал по умолчанию и соединение на каждый вызов
+        with sqlite3.connect(legacy_path) as conn:
+            conn.execute("PRAGMA journal_mode = DELETE")
+        read_before = measure("get_user (connect per call)", lambda uid: legacy_get_user(legacy_path, uid), ops)
+        write_before = measure("lobby join/leave (per call)", lambda uid: legacy_lobby_toggle(legacy_path, uid), ops // 5)
+
+        # "После": постоянное соединение, WAL и настроенные PRAGMA
+        db.DB_PATH = pooled_path
+        read_after = measure("get_user (pooled)", db.get_user, ops)
+        write_after = measure("lobby join/leave (pooled)", pooled_lobby_toggle, ops // 5)
+        db.close_connections()
+
+    print(f"\nЧтение: x{read_after / read_before:.1f}, запись: x{write_after / write_before:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Бенчмарк отрисовки списка лобби: запрос на каждое лобби против одного pipeline.
+
+Запуск: python benchmarks/bench_lobbies.py [кол-во отрисовок]
+Использует Redis из REDIS_URL (лучше отдельную базу, например redis://localhost:6379/15),
+ключи лобби в ней будут перезаписаны. С флагом --fake работает на fakeredis, если он установлен.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if "--fake" in sys.argv:
+    import fakeredis
+    import redis.asyncio as redis
+    redis.from_url = lambda *args, **kwargs: fakeredis.FakeAsyncRedis(decode_responses=True)
+    sys.argv.remove("--fake")
+
+from redis.asyncio.client import Pipeline
+
+import state
+
+round_trips = 0
+
+def count_round_trips():
+    # Каждая одиночная команда и каждый pipeline.execute() - один round trip
+    execute_command = state.r.execute_command
+    pipeline_execute = Pipeline.execute
+
+    async def counted_command(*args, **kwargs):
+        global round_trips
+        round_trips += 1
+        return await execute_command(*args, **kwargs)
+
+    async def counted_pipeline(self, *args, **kwargs):
+        global round_trips
+        round_trips += 1
+        return await pipeline_execute(self, *args, **kwargs)
+
+    state.r.execute_command = counted_command
+    Pipeline.execute = counted_pipeline
+
+async def legacy_render():
+    # Как раньше: отдельный запрос на каждое из 30 лобби
+    result = {}
+    for mode in state.MODES:
+        result[mode] = [len(await state.get_lobby_players(mode, lid)) for lid in state.LOBBY_IDS]
+    return result
+
+async def measure(name, render, renders):
+    global round_trips
+    round_trips = 0
+    start = time.perf_counter()
+    for _ in range(renders):
+        await render()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {round_trips / renders:6.1f} round trips/отрисовку  {elapsed * 1000 / renders:8.3f} мс/отрисовку")
+
+async def main():
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    await state.clear_lobbies()
+    for mode in state.MODES:
+        for lid in state.LOBBY_IDS:
+            for uid in range(lid % state.MAX_PLAYERS[mode]):
+                await state.add_player_to_lobby(mode, lid, f"{mode}{lid}{uid}", {"nickname": f"p{uid}", "level": 4})
+    count_round_trips()
+
+    await measure("по одному лобби", legacy_render, renders)
+    await measure("get_lobbies_snapshot", state.get_lobbies_snapshot, renders)
+    await measure("snapshot с составами", lambda: state.get_lobbies_snapshot(with_players=True), renders)
+    await state.clear_lobbies()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,45 +1,163 @@
-import state
-import db
+"""Сервис лобби поверх Redis - общий для бота и Mini App.
+
+Состав лобби хранится только в Redis (state.py), таблица lobby_members в
+SQLite - копия для восстановления после перезапуска. Вход, выход, снимок
+и поиск игрока идут через этот модуль, поэтому бот и /api/lobby/enter
+меняют и видят одно и то же состояние в любом процессе. Реакцию на
+изменения (перерисовка экранов лобби в Telegram, сбор матча при
+заполнении) main.py подключает через setup: она срабатывает одинаково,
+откуда бы игрок ни вошел.
+"""
 import asyncio
 import logging
 
-async def join_lobby(user_id, mode, lobby_id, bot=None):
-    user = db.get_user(user_id)
+import async_db
+import bans
+import state
+
+_on_changed = None
+_on_full = None
+_tasks = set()
+
+def setup(on_changed=None, on_full=None):
+    """on_changed(mode, lobby_id) - после изменения состава, on_full(mode, lobby_id) - лобби заполнено."""
+    global _on_changed, _on_full
+    _on_changed = on_changed
+    _on_full = on_full
+
+def is_valid_lobby(mode, lobby_id):
+    return mode in state.MAX_PLAYERS and lobby_id in state.LOBBY_IDS
+
+async def _notify_changed(lobbies):
+    if _on_changed is None:
+        return
+    for mode, lobby_id in lobbies:
+        try:
+            await _on_changed(mode, lobby_id)
+        except Exception as e:
+            logging.error(f"Lobby change handler failed for {mode} #{lobby_id}: {e}")
+
+async def _run_full(mode, lobby_id):
+    try:
+        await _on_full(mode, lobby_id)
+    except Exception as e:
+        logging.error(f"Lobby full handler failed for {mode} #{lobby_id}: {e}")
+
+def _notify_full(mode, lobby_id):
+    # Сбор матча не должен задерживать ответ тому, кто вошел последним
+    if _on_full is None:
+        return
+    task = asyncio.create_task(_run_full(mode, lobby_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def join_lobby(user_id, mode, lobby_id):
+    if not is_valid_lobby(mode, lobby_id):
+        return {"status": "error", "message": "Unknown lobby"}
+    # Бан проверяется здесь, а не только в BanMiddleware бота: Mini App входит в лобби напрямую
+    banned, ban_until = await bans.get_active_ban(user_id)
+    if banned:
+        return {"status": "error", "message": "Banned", "ban_until": ban_until}
+    user = await async_db.get_user(user_id)
     if not user:
         return {"status": "error", "message": "User not registered"}
-    
-    lobby = state.lobby_players[mode][lobby_id]
-    max_p = 2 if mode == "1x1" else (4 if mode == "2x2" else 10)
-    
-    if user_id in lobby:
+
+    player_data = {"nickname": user[1], "level": user[3], "game_id": user[0]}
+
+    # Проверка вместимости, выход из другого лобби и вход - одним атомарным скриптом в Redis
+    result = await state.join_lobby(mode, lobby_id, user_id, player_data)
+
+    if result["status"] == "already":
         return {"status": "error", "message": "Already in lobby"}
-        
-    if len(lobby) >= max_p:
+
+    if result["status"] == "full":
         return {"status": "error", "message": "Lobby full"}
-    
-    # Check if in another lobby
-    for m in state.lobby_players:
-        for lid in state.lobby_players[m]:
-            if user_id in state.lobby_players[m][lid]:
-                del state.lobby_players[m][lid][user_id]
-                db.remove_lobby_member(user_id)
-                # We should notify bot to update messages here, but we'll do it via a callback or event
-    
-    level = user[3] # Assuming index 3 is level
-    state.lobby_players[mode][lobby_id][user_id] = {"nickname": user[1], "level": level, "game_id": user[0]}
-    db.add_lobby_member(mode, lobby_id, user_id)
-    
-    if len(state.lobby_players[mode][lobby_id]) >= max_p:
-        # Trigger match creation (this needs to be handled carefully to avoid circular deps)
-        # We'll use a task for this
-        return {"status": "success", "action": "joined", "full": True}
-    
-    return {"status": "success", "action": "joined", "full": False}
+
+    if result["left"]:
+        await async_db.remove_lobby_member(user_id)
+    await async_db.add_lobby_member(mode, lobby_id, user_id)
+
+    await _notify_changed([(mode, lobby_id), *result["left"]])
+    # Заполнение видит только вошедший последним: скрипт входа атомарный
+    full = result["count"] >= state.MAX_PLAYERS[mode]
+    if full:
+        _notify_full(mode, lobby_id)
+
+    # Лобби, из которых игрок вышел
+    left = [{"mode": m, "id": lid} for m, lid in result["left"]]
+    return {"status": "success", "action": "joined", "full": full, "left": left}
 
 async def leave_lobby(user_id, mode, lobby_id):
-    lobby = state.lobby_players[mode][lobby_id]
-    if user_id in lobby:
-        del lobby[user_id]
-        db.remove_lobby_member(user_id)
+    if is_valid_lobby(mode, lobby_id) and await state.remove_player_from_lobby(mode, lobby_id, user_id):
+        await async_db.remove_lobby_member(user_id)
+        await _notify_changed([(mode, lobby_id)])
         return {"status": "success", "action": "left"}
     return {"status": "error", "message": "Not in lobby"}
+
+async def leave_current_lobby(user_id):
+    # Выход из лобби, где игрок числится по обратному индексу
+    current = await find_user_lobby(user_id)
+    if not current:
+        return {"status": "error", "message": "Not in lobby"}
+    result = await leave_lobby(user_id, current["mode"], current["id"])
+    if result["status"] == "success":
+        result["lobby"] = current
+    return result
+
+async def return_to_lobby(user_id, mode, lobby_id, player_data):
+    # Возврат игрока после сорванного матча - без проверки вместимости
+    result = await state.add_player_to_lobby(mode, lobby_id, user_id, player_data)
+    if result["left"]:
+        await async_db.remove_lobby_member(user_id)
+    await async_db.add_lobby_member(mode, lobby_id, user_id)
+    await _notify_changed([(mode, lobby_id), *result["left"]])
+
+async def find_user_lobby(user_id):
+    return await state.get_user_current_lobby(user_id)
+
+async def get_players(mode, lobby_id):
+    return await state.get_lobby_players(mode, lobby_id)
+
+async def find_empty_lobby(mode):
+    snapshot = await state.get_lobbies_snapshot([mode])
+    for lobby in snapshot[mode]:
+        if lobby["players"] == 0:
+            return lobby["id"]
+    return None
+
+def _mark_user_lobby(lobby, mode, user_lobby):
+    return {**lobby, "is_user_here": user_lobby == {"mode": mode, "id": lobby["id"]}}
+
+async def get_snapshot(user_id=None, modes=None):
+    # Счетчики всех лобби и лобби пользователя: {"modes": {mode: [...]}, "user_lobby": ...}
+    if user_id is None:
+        snapshot = await state.get_lobbies_snapshot(modes)
+        return {"modes": snapshot, "user_lobby": None}
+    # Текущее лобби пользователя (обратный индекс) и счетчики всех лобби (один pipeline) параллельно
+    user_lobby, snapshot = await asyncio.gather(
+        find_user_lobby(user_id),
+        state.get_lobbies_snapshot(modes)
+    )
+    return {
+        "modes": {
+            mode: [_mark_user_lobby(lobby, mode, user_lobby) for lobby in lobbies]
+            for mode, lobbies in snapshot.items()
+        },
+        "user_lobby": user_lobby
+    }
+
+async def get_changes(user_id, since):
+    # Лобби, изменившиеся после версии since, или None, если нужен полный снимок
+    (version, changes), user_lobby = await asyncio.gather(
+        state.get_lobby_changes(since),
+        find_user_lobby(user_id)
+    )
+    if changes is None:
+        return None
+    if not changes:
+        return {"version": version, "unchanged": True, "user_lobby": user_lobby}
+    return {
+        "version": version,
+        "changes": [_mark_user_lobby(lobby, lobby["mode"], user_lobby) for lobby in changes],
+        "user_lobby": user_lobby
+    }
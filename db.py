@@ -1,8 +1,58 @@
+import os
 import sqlite3
-
-def init_db():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+import threading
+import time
+
+DB_PATH = os.getenv("DB_PATH", "database.db")
+
+# Настройки соединения: WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL убирает fsync на каждый коммит (в режиме WAL это безопасно)
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",      # ~16 МБ страничного кэша
+    "PRAGMA mmap_size = 268435456",    # 256 МБ memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+def open_connection(path=None, read_only=False):
+    conn = sqlite3.connect(path or DB_PATH, timeout=5, cached_statements=256, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        # Соединение-читатель: любая попытка записи упадет с ошибкой
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+def get_connection(read_only=False):
+    # Одно долгоживущее соединение на поток вместо connect/close на каждый запрос.
+    # read_only учитывается только при первом вызове в потоке (см. async_db)
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = open_connection(read_only=read_only)
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def close_connections():
+    with _connections_lock:
+        for conn in _connections:
+            try: conn.close()
+            except sqlite3.Error: pass
+        _connections.clear()
+    _local.__dict__.pop("conn", None)
+
+# Миграции схемы. Номер миграции = позиция в MIGRATIONS (с 1), примененная
+# версия хранится в PRAGMA user_version, поэтому каждая миграция выполняется один раз.
+# Новые миграции добавляются только в конец списка.
+
+def _migrate_base_schema(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -14,7 +64,7 @@ def init_db():
             wins INTEGER DEFAULT 0
         )
     ''')
-    
+
     # Таблица для хранения матчей
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS matches (
@@ -45,7 +95,7 @@ def init_db():
             admin_id INTEGER
         )
     ''')
-    
+
     # Таблица для лобби (синхронизация участников)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS lobby_members (
@@ -67,13 +117,13 @@ def init_db():
         cursor.execute('ALTER TABLE users ADD COLUMN ban_until DATETIME')
     if 'missed_games' not in columns:
         cursor.execute('ALTER TABLE users ADD COLUMN missed_games INTEGER DEFAULT 0')
-        
+
     # Миграция: проверяем наличие колонки admin_id в support_tickets
     cursor.execute("PRAGMA table_info(support_tickets)")
     st_columns = [column[1] for column in cursor.fetchall()]
     if 'admin_id' not in st_columns:
         cursor.execute('ALTER TABLE support_tickets ADD COLUMN admin_id INTEGER')
-    
+
     # Миграция для matches
     cursor.execute("PRAGMA table_info(matches)")
     m_columns = [column[1] for column in cursor.fetchall()]
@@ -82,264 +132,302 @@ def init_db():
     if 'created_at' not in m_columns:
         cursor.execute('ALTER TABLE matches ADD COLUMN created_at DATETIME')
 
+def _migrate_reset_default_levels(cursor):
     # Принудительное обновление всех игроков на 4 уровень, если ELO 1000
     cursor.execute('UPDATE users SET level = 4 WHERE elo = 1000')
-        
-    conn.commit()
-    conn.close()
+
+def _migrate_add_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_elo ON users (elo DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_nickname ON users (nickname)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_game_id ON users (game_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_match_players_user ON match_players (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_lobby_members_user ON lobby_members (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_support_tickets_status ON support_tickets (status)')
+
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_reset_default_levels,
+    _migrate_add_indexes,
+]
+
+def get_schema_version():
+    return get_connection().execute('PRAGMA user_version').fetchone()[0]
+
+def init_db():
+    conn = get_connection()
+    version = get_schema_version()
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        # Миграция и повышение user_version коммитятся вместе. IMMEDIATE сразу берет
+        # блокировку записи: если init_db одновременно запущен в нескольких воркерах,
+        # остальные дождутся ее и увидят уже примененную миграцию
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if get_schema_version() >= number:
+                continue
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+    if version < len(MIGRATIONS):
+        conn.execute('PRAGMA optimize')
+
+USER_COLUMNS = 'user_id, game_id, nickname, elo, level, is_banned, ban_until, missed_games'
 
 def get_all_users():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, game_id, nickname, elo, level, is_banned, ban_until, missed_games FROM users')
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    cursor = get_connection().cursor()
+    cursor.execute(f'SELECT {USER_COLUMNS} FROM users')
+    return cursor.fetchall()
+
+def get_users_page(after_id=0, before_id=None, limit=10):
+    # Keyset-пагинация по user_id: страница читается по индексу первичного ключа,
+    # без OFFSET и без выгрузки всей таблицы. Возвращает (users, has_prev, has_next)
+    cursor = get_connection().cursor()
+    if before_id is not None:
+        cursor.execute(f'SELECT {USER_COLUMNS} FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?', (before_id, limit + 1))
+        rows = cursor.fetchall()
+        has_prev = len(rows) > limit
+        return rows[:limit][::-1], has_prev, True
+    cursor.execute(f'SELECT {USER_COLUMNS} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after_id, limit + 1))
+    rows = cursor.fetchall()
+    has_prev = bool(rows) and cursor.execute('SELECT 1 FROM users WHERE user_id < ? LIMIT 1', (rows[0][0],)).fetchone() is not None
+    return rows[:limit], has_prev, len(rows) > limit
+
+USER_COUNT_TTL = 60
+_user_count_cache = {"value": None, "expires": 0.0}
+
+def count_users():
+    # COUNT(*) проходит всю таблицу, поэтому результат кэшируется на USER_COUNT_TTL секунд
+    now = time.monotonic()
+    if _user_count_cache["value"] is None or _user_count_cache["expires"] <= now:
+        cursor = get_connection().cursor()
+        cursor.execute('SELECT COUNT(*) FROM users')
+        _user_count_cache["value"] = cursor.fetchone()[0]
+        _user_count_cache["expires"] = now + USER_COUNT_TTL
+    return _user_count_cache["value"]
 
 def increment_missed_games(user_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET missed_games = missed_games + 1 WHERE user_id = ?', (user_id,))
-    cursor.execute('SELECT missed_games FROM users WHERE user_id = ?', (user_id,))
-    count = cursor.fetchone()[0]
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET missed_games = missed_games + 1 WHERE user_id = ?', (user_id,))
+        cursor.execute('SELECT missed_games FROM users WHERE user_id = ?', (user_id,))
+        count = cursor.fetchone()[0]
     return count
 
 def reset_missed_games(user_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET missed_games = 0 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('UPDATE users SET missed_games = 0 WHERE user_id = ?', (user_id,))
+
+def get_ban_status(user_id):
+    # Точечный запрос по первичному ключу вместо выгрузки всей таблицы
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT is_banned, ban_until FROM users WHERE user_id = ?', (user_id,))
+    return cursor.fetchone() # (is_banned, ban_until) или None
 
 def set_ban_status(user_id, status, until=None):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    if status:
-        cursor.execute('UPDATE users SET is_banned = 1, ban_until = ? WHERE user_id = ?', (until, user_id))
-    else:
-        cursor.execute('UPDATE users SET is_banned = 0, ban_until = NULL WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        if status:
+            conn.execute('UPDATE users SET is_banned = 1, ban_until = ? WHERE user_id = ?', (until, user_id))
+        else:
+            conn.execute('UPDATE users SET is_banned = 0, ban_until = NULL WHERE user_id = ?', (user_id,))
 
 def create_match(mode, players_ids):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO matches (status, mode) VALUES ("pending", ?)', (mode,))
-    match_id = cursor.lastrowid
-    
-    for uid in players_ids:
-        cursor.execute('INSERT INTO match_players (match_id, user_id) VALUES (?, ?)', (match_id, uid))
-        
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO matches (status, mode) VALUES ("pending", ?)', (mode,))
+        match_id = cursor.lastrowid
+        cursor.executemany('INSERT INTO match_players (match_id, user_id) VALUES (?, ?)',
+                           [(match_id, uid) for uid in players_ids])
     return match_id
 
 def accept_match_player(match_id, user_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE match_players SET accepted = 1 WHERE match_id = ? AND user_id = ?', (match_id, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('UPDATE match_players SET accepted = 1 WHERE match_id = ? AND user_id = ?', (match_id, user_id))
 
 def get_match_players(match_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('''
-        SELECT mp.user_id, u.nickname, u.elo, u.level, mp.accepted 
+        SELECT mp.user_id, u.nickname, u.elo, u.level, mp.accepted
         FROM match_players mp
         JOIN users u ON mp.user_id = u.user_id
         WHERE mp.match_id = ?
     ''', (match_id,))
-    players = cursor.fetchall()
-    conn.close()
-    return players # [(user_id, nickname, elo, level, accepted), ...]
+    return cursor.fetchall() # [(user_id, nickname, elo, level, accepted), ...]
 
 def cancel_match(match_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE matches SET status = "cancelled" WHERE id = ?', (match_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('UPDATE matches SET status = "cancelled" WHERE id = ?', (match_id,))
 
 def get_pending_match(match_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT id, mode, status FROM matches WHERE id = ? AND status = "pending"', (match_id,))
-    match = cursor.fetchone()
-    conn.close()
-    return match
+    return cursor.fetchone()
+
+# Верхние границы ELO для уровней 1-9, выше последней границы - 10 уровень
+LEVEL_THRESHOLDS = (500, 750, 900, 1050, 1200, 1350, 1530, 1750, 2000)
 
 def get_level_by_elo(elo):
-    if elo <= 500: return 1
-    if elo <= 750: return 2
-    if elo <= 900: return 3
-    if elo <= 1050: return 4
-    if elo <= 1200: return 5
-    if elo <= 1350: return 6
-    if elo <= 1530: return 7
-    if elo <= 1750: return 8
-    if elo <= 2000: return 9
-    return 10
+    for level, max_elo in enumerate(LEVEL_THRESHOLDS, start=1):
+        if elo <= max_elo:
+            return level
+    return len(LEVEL_THRESHOLDS) + 1
+
+# То же вычисление уровня на стороне SQLite, для массовых UPDATE
+LEVEL_SQL = "CASE " + " ".join(
+    f"WHEN elo <= {max_elo} THEN {level}" for level, max_elo in enumerate(LEVEL_THRESHOLDS, start=1)
+) + f" ELSE {len(LEVEL_THRESHOLDS) + 1} END"
 
 def add_user(user_id, game_id, nickname):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    # Убеждаемся, что при добавлении ставим elo 1000 и level 4 (хотя DEFAULT в БД есть, INSERT OR REPLACE может затирать)
-    cursor.execute('INSERT OR REPLACE INTO users (user_id, game_id, nickname, elo, level) VALUES (?, ?, ?, 1000, 4)', 
-                   (user_id, game_id, nickname))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        # Убеждаемся, что при добавлении ставим elo 1000 и level 4 (хотя DEFAULT в БД есть, INSERT OR REPLACE может затирать)
+        conn.execute('INSERT OR REPLACE INTO users (user_id, game_id, nickname, elo, level) VALUES (?, ?, ?, 1000, 4)',
+                     (user_id, game_id, nickname))
+    _user_count_cache["value"] = None
 
 def get_user(user_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT game_id, nickname, elo, level, matches, wins FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    return cursor.fetchone()
 
 def get_top_players(limit=10):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT nickname, elo, level FROM users ORDER BY elo DESC LIMIT ?', (limit,))
-    players = cursor.fetchall()
-    conn.close()
-    return players
+    return cursor.fetchall()
+
+def get_leaderboard_entries(user_ids=None):
+    # Данные для Redis-зеркала лидерборда: (user_id, nickname, elo)
+    cursor = get_connection().cursor()
+    if user_ids is None:
+        cursor.execute('SELECT user_id, nickname, elo FROM users')
+    else:
+        user_ids = list(user_ids)
+        placeholders = ", ".join("?" * len(user_ids))
+        cursor.execute(f'SELECT user_id, nickname, elo FROM users WHERE user_id IN ({placeholders})', user_ids)
+    return cursor.fetchall()
 
 def update_elo(user_id, elo_change, is_win):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users 
-        SET elo = elo + ?, 
-            matches = matches + 1,
-            wins = wins + ?
-        WHERE user_id = ?
-    ''', (elo_change, 1 if is_win else 0, user_id))
-    
-    # Также обновляем уровень на основе нового ELO
-    cursor.execute('SELECT elo FROM users WHERE user_id = ?', (user_id,))
-    new_elo = cursor.fetchone()[0]
-    new_level = get_level_by_elo(new_elo)
-    cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
-    
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users
+            SET elo = elo + ?,
+                matches = matches + 1,
+                wins = wins + ?
+            WHERE user_id = ?
+        ''', (elo_change, 1 if is_win else 0, user_id))
+
+        # Также обновляем уровень на основе нового ELO
+        cursor.execute('SELECT elo FROM users WHERE user_id = ?', (user_id,))
+        new_elo = cursor.fetchone()[0]
+        new_level = get_level_by_elo(new_elo)
+        cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
 
 def manual_update_elo(user_id, elo_change):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users 
-        SET elo = elo + ?
-        WHERE user_id = ?
-    ''', (elo_change, user_id))
-    
-    # Also update level based on new ELO
-    cursor.execute('SELECT elo FROM users WHERE user_id = ?', (user_id,))
-    new_elo = cursor.fetchone()[0]
-    new_level = get_level_by_elo(new_elo)
-    cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
-    
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users
+            SET elo = elo + ?
+            WHERE user_id = ?
+        ''', (elo_change, user_id))
+
+        # Also update level based on new ELO
+        cursor.execute('SELECT elo FROM users WHERE user_id = ?', (user_id,))
+        new_elo = cursor.fetchone()[0]
+        new_level = get_level_by_elo(new_elo)
+        cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
 
 def adjust_user_stats(user_id, matches_change, wins_change):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users 
-        SET matches = matches + ?,
-            wins = wins + ?
-        WHERE user_id = ?
-    ''', (matches_change, wins_change, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('''
+            UPDATE users
+            SET matches = matches + ?,
+                wins = wins + ?
+            WHERE user_id = ?
+        ''', (matches_change, wins_change, user_id))
+
+def settle_match(match_id, winners, losers, delta):
+    # Все изменения по матчу одной транзакцией: ELO, матчи, победы, уровни и статус матча.
+    # Возвращает False, если матч уже рассчитан (например, двойное нажатие админов) или отменен.
+    # Идущий матч в SQLite остается 'pending' с момента create_match, 'active' - значение
+    # по умолчанию в схеме для старых записей
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE matches SET status = 'finished' WHERE id = ? AND status IN ('pending', 'active')",
+            (match_id,)
+        )
+        if cursor.rowcount == 0:
+            return False
+
+        cursor.executemany('''
+            UPDATE users
+            SET elo = elo + ?,
+                matches = matches + 1,
+                wins = wins + ?
+            WHERE user_id = ?
+        ''', [(delta, 1, uid) for uid in winners] + [(-delta, 0, uid) for uid in losers])
+
+        # Уровень считается в SQL по уже обновленному ELO
+        player_ids = list(winners) + list(losers)
+        placeholders = ", ".join("?" * len(player_ids))
+        cursor.execute(f'UPDATE users SET level = {LEVEL_SQL} WHERE user_id IN ({placeholders})', player_ids)
+    return True
 
 def create_support_ticket(user_id, text):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO support_tickets (user_id, text) VALUES (?, ?)', (user_id, text))
-    ticket_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO support_tickets (user_id, text) VALUES (?, ?)', (user_id, text))
+        ticket_id = cursor.lastrowid
     return ticket_id
 
 def get_support_ticket(ticket_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT user_id, text, admin_id, status FROM support_tickets WHERE id = ?', (ticket_id,))
-    ticket = cursor.fetchone()
-    conn.close()
-    return ticket
+    return cursor.fetchone()
 
 def get_all_tickets():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT id, user_id, text, status FROM support_tickets WHERE status = "open"')
-    tickets = cursor.fetchall()
-    conn.close()
-    return tickets
+    return cursor.fetchall()
 
 def add_lobby_member(mode, lobby_id, user_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO lobby_members (mode, lobby_id, user_id) VALUES (?, ?, ?)', (mode, lobby_id, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('INSERT OR REPLACE INTO lobby_members (mode, lobby_id, user_id) VALUES (?, ?, ?)', (mode, lobby_id, user_id))
 
 def remove_lobby_member(user_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM lobby_members WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('DELETE FROM lobby_members WHERE user_id = ?', (user_id,))
 
 def get_all_lobby_members():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT mode, lobby_id, user_id FROM lobby_members')
-    members = cursor.fetchall()
-    conn.close()
-    return members
+    return cursor.fetchall()
 
 def update_support_ticket(ticket_id, admin_id=None, status=None):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    if admin_id is not None:
-        cursor.execute('UPDATE support_tickets SET admin_id = ? WHERE id = ?', (admin_id, ticket_id))
-    if status is not None:
-        cursor.execute('UPDATE support_tickets SET status = ? WHERE id = ?', (status, ticket_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        if admin_id is not None:
+            conn.execute('UPDATE support_tickets SET admin_id = ? WHERE id = ?', (admin_id, ticket_id))
+        if status is not None:
+            conn.execute('UPDATE support_tickets SET status = ? WHERE id = ?', (status, ticket_id))
 
 def close_ticket(ticket_id, admin_id):
     update_support_ticket(ticket_id, admin_id=admin_id, status='closed')
 
 def update_user_profile(user_id, nickname=None, game_id=None):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    if nickname:
-        cursor.execute('UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
-    if game_id:
-        cursor.execute('UPDATE users SET game_id = ? WHERE user_id = ?', (game_id, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        if nickname:
+            conn.execute('UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
+        if game_id:
+            conn.execute('UPDATE users SET game_id = ? WHERE user_id = ?', (game_id, user_id))
 
 def get_user_by_nickname(nickname):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT user_id FROM users WHERE nickname = ?', (nickname,))
     user = cursor.fetchone()
-    conn.close()
     return user[0] if user else None
 
 def get_user_by_game_id(game_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute('SELECT user_id FROM users WHERE game_id = ?', (game_id,))
     user = cursor.fetchone()
-    conn.close()
     return user[0] if user else None
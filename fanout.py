@@ -0,0 +1,118 @@
+"""Параллельная рассылка сообщений и правок множеству получателей.
+
+Вызывающий код один раз собирает текст и клавиатуры, а сюда передает
+готовые вызовы Bot API (broadcast) или текст события матча (notify). Одновременно ожидается не больше
+FANOUT_CONCURRENCY запросов. Сами запросы проходят через outbox с
+приоритетом level: по умолчанию PRIORITY_LOBBY у broadcast и
+PRIORITY_MATCH у notify, поэтому события матчей идут вперед обновлений
+лобби. Лимиты Telegram и повторы после 429 обрабатываются в outbox.
+
+Недоставленные получатели делятся на dead (бот заблокирован, сообщение
+удалено - TelegramForbiddenError/TelegramBadRequest, повторять бессмысленно)
+и failed (временная ошибка: 429 сверх лимита повторов, переполненный outbox,
+сеть или 5xx Telegram). Ошибки сети и 5xx повторяются до FANOUT_RETRIES раз.
+Исключения не из Telegram API - ошибки в коде - пробрасываются.
+"""
+import asyncio
+import logging
+import os
+import time
+from functools import partial
+
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError
+)
+
+import outbox
+
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", 8))
+FANOUT_RETRIES = int(os.getenv("FANOUT_RETRIES", 2))
+FANOUT_RETRY_DELAY = float(os.getenv("FANOUT_RETRY_DELAY", 0.5))
+
+# Накопительные метрики рассылок
+stats = {
+    "broadcasts": 0,
+    "messages": 0,
+    "dead": 0,
+    "failed": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0,
+    "last_ms": 0.0,
+}
+
+async def _deliver(call, semaphore):
+    async with semaphore:
+        for attempt in range(FANOUT_RETRIES + 1):
+            try:
+                return "ok", await call()
+            except (TelegramRetryAfter, outbox.OutboxDropped):
+                return "failed", None
+            except TelegramForbiddenError:
+                return "dead", None
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    return "ok", None
+                return "dead", None
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == FANOUT_RETRIES:
+                    logging.warning(f"Fan-out call failed after {attempt + 1} attempts: {e}")
+                    return "failed", None
+                await asyncio.sleep(FANOUT_RETRY_DELAY * (attempt + 1))
+            except TelegramAPIError as e:
+                logging.warning(f"Fan-out call failed: {e}")
+                return "failed", None
+
+async def broadcast(name, calls, concurrency=None, level=outbox.PRIORITY_LOBBY):
+    """Выполняет calls ({ключ: вызов без аргументов}) параллельно.
+
+    Возвращает {"sent", "results", "dead", "failed", "elapsed_ms"}:
+    results - ответы успешных вызовов по ключам, dead - ключи, чьи
+    сообщения не доставляются (удалены, бот заблокирован), failed - ключи
+    с временной ошибкой (outbox отбросил, сеть или 5xx после повторов).
+    """
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency or FANOUT_CONCURRENCY)
+    keys = list(calls)
+    with outbox.priority(level):
+        results = await asyncio.gather(*(_deliver(calls[key], semaphore) for key in keys))
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    report = {"sent": 0, "results": {}, "dead": [], "failed": [], "elapsed_ms": elapsed_ms}
+    for key, (status, result) in zip(keys, results):
+        if status == "ok":
+            report["sent"] += 1
+            report["results"][key] = result
+        else:
+            report[status].append(key)
+
+    stats["broadcasts"] += 1
+    stats["messages"] += len(keys)
+    stats["dead"] += len(report["dead"])
+    stats["failed"] += len(report["failed"])
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    stats["last_ms"] = elapsed_ms
+    logging.debug(f"Fan-out {name}: {len(keys)} msgs, {report['sent']} sent, "
+                  f"{len(report['dead'])} dead, {len(report['failed'])} failed, {elapsed_ms:.1f} ms")
+    return report
+
+async def notify(name, bot, messages, level=outbox.PRIORITY_MATCH, **kwargs):
+    """Доставляет одно событие матча всем получателям параллельно.
+
+    messages - {chat_id: текст}, kwargs (reply_markup и т.п.) общие для
+    всех. К отчету broadcast добавляется "message_ids": {chat_id: id}
+    доставленных сообщений - для последующих правок.
+    """
+    calls = {chat_id: partial(bot.send_message, chat_id, text, **kwargs) for chat_id, text in messages.items()}
+    report = await broadcast(name, calls, level=level)
+    report["message_ids"] = {chat_id: msg.message_id for chat_id, msg in report["results"].items() if msg}
+    undelivered = report["dead"] + report["failed"]
+    if undelivered:
+        logging.warning(f"Notification {name} not delivered to {undelivered}")
+    return report
+
+def get_stats():
+    result = dict(stats)
+    result["avg_ms"] = stats["total_ms"] / stats["broadcasts"] if stats["broadcasts"] else 0.0
+    return result
@@ -0,0 +1,76 @@
+"""Условные GET и кэш готовых ответов для читающих эндпоинтов Mini App.
+
+Каждый ответ привязан к версии данных в Redis: lobby_version для лобби,
+leaderboard_version для рейтинга, версия профиля для /api/user. К версии
+добавляется эпоха Redis (state.get_cache_version): после очистки Redis
+счетчики начинаются заново, но эпоха уже другая, и старые ETag не
+совпадут. ETag строится из ключа ответа, эпохи и версии, поэтому одинаков
+во всех воркерах: если клиент прислал его в If-None-Match, отвечаем 304
+без тела. Иначе сериализованный JSON берется из LRU-кэша процесса и
+собирается заново, только когда версия выросла - изменение ELO, лобби или
+профиля само делает старую запись неактуальной. RESPONSE_CACHE_TTL
+дополнительно ограничивает жизнь записи в кэше.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import Response
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 2048))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 60))
+
+_cache = OrderedDict()
+
+stats = {
+    "not_modified": 0,
+    "hits": 0,
+    "misses": 0,
+}
+
+def make_etag(key, version):
+    epoch, number = version
+    digest = hashlib.blake2s(repr(key).encode(), digest_size=8).hexdigest()
+    return f'W/"{digest}-{epoch}-{number}"'
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Для GET сравнение слабое: префикс W/ не учитываем
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag.removeprefix("W/") in tags
+
+async def respond(request, key, version, build):
+    """Ответ для ключа key при версии version = (эпоха, номер); build - корутинная функция, собирающая данные."""
+    etag = make_etag(key, version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+
+    now = time.monotonic()
+    entry = _cache.get(key)
+    if entry and entry[0] == version and now - entry[1] < RESPONSE_CACHE_TTL:
+        stats["hits"] += 1
+        _cache.move_to_end(key)
+        body = entry[2]
+    else:
+        stats["misses"] += 1
+        body = json.dumps(await build(), ensure_ascii=False, separators=(",", ":")).encode()
+        _cache[key] = (version, now, body)
+        _cache.move_to_end(key)
+        while len(_cache) > RESPONSE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def get_stats():
+    result = dict(stats)
+    total = stats["not_modified"] + stats["hits"] + stats["misses"]
+    result["requests"] = total
+    result["hit_rate"] = (stats["not_modified"] + stats["hits"]) / total if total else 0.0
+    result["size"] = len(_cache)
+    return result
@@ -0,0 +1,143 @@
+"""Push-обновления лобби для Mini App (Server-Sent Events).
+
+state.py публикует в Redis-канал LOBBY_EVENTS_CHANNEL каждое изменение
+состава лобби - и из бота, и из API, в любом процессе. Здесь один
+подписчик на процесс (только пока открыт хотя бы один поток: он
+запускается первым subscribe и останавливается с последним unsubscribe)
+собирает эти события, через refresh объединяет
+всплеск изменений в один снимок всех лобби (один pipeline) и раздает его
+всем открытым потокам процесса. Каждый поток хранит только последний
+снимок: медленный клиент пропускает промежуточные состояния, а не
+накапливает очередь.
+"""
+import asyncio
+import json
+import logging
+
+import refresh
+import state
+
+class Subscription:
+    def __init__(self):
+        self.update = None
+        self.closed = False
+        self.changed = asyncio.Event()
+
+    def push(self, version, snapshot):
+        self.update = (version, snapshot)
+        self.changed.set()
+
+    def close(self):
+        self.closed = True
+        self.changed.set()
+
+    async def wait(self, timeout):
+        # (версия, снимок) или None, если за timeout ничего не изменилось или поток закрыт
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.changed.clear()
+        if self.closed:
+            return None
+        return self.update
+
+_subscriptions = set()
+_listener = None
+
+stats = {
+    "events": 0,
+    "snapshots": 0,
+    "pushed": 0,
+}
+
+async def _broadcast_snapshot():
+    if not _subscriptions:
+        return
+    version = await state.get_lobby_version()
+    snapshot = await state.get_lobbies_snapshot(with_players=True)
+    stats["snapshots"] += 1
+    for subscription in list(_subscriptions):
+        subscription.push(version, snapshot)
+        stats["pushed"] += 1
+
+async def _listen():
+    while True:
+        pubsub = state.r.pubsub()
+        try:
+            await pubsub.subscribe(state.LOBBY_EVENTS_CHANNEL)
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                stats["events"] += 1
+                refresh.schedule(("lobby_push",), _broadcast_snapshot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Lobby events subscription failed: {e}")
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+def subscribe():
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.create_task(_listen())
+    subscription = Subscription()
+    _subscriptions.add(subscription)
+    return subscription
+
+def unsubscribe(subscription):
+    global _listener
+    _subscriptions.discard(subscription)
+    # Последний поток закрыт - отписываемся от канала, следующий subscribe подпишется заново
+    if not _subscriptions and _listener is not None:
+        _listener.cancel()
+        _listener = None
+
+async def close():
+    # Остановка процесса: завершаем открытые потоки и подписку на Redis
+    global _listener
+    for subscription in list(_subscriptions):
+        subscription.close()
+    _subscriptions.clear()
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.gather(_listener, return_exceptions=True)
+        _listener = None
+
+def user_view(snapshot, user_id, version=None):
+    # Снимок с составами -> полный ответ /api/lobbies/{user_id}: версия, счетчики и флаг is_user_here
+    uid = str(user_id)
+    user_lobby = None
+    for mode, lobbies in snapshot.items():
+        for lobby in lobbies:
+            if uid in lobby.get("roster", {}):
+                user_lobby = {"mode": mode, "id": lobby["id"]}
+    return {
+        "version": version,
+        "modes": {
+            mode: [
+                {
+                    "id": lobby["id"],
+                    "players": lobby["players"],
+                    "max": lobby["max"],
+                    "is_user_here": user_lobby == {"mode": mode, "id": lobby["id"]}
+                }
+                for lobby in lobbies
+            ]
+            for mode, lobbies in snapshot.items()
+        },
+        "user_lobby": user_lobby
+    }
+
+def format_event(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def get_stats():
+    result = dict(stats)
+    result["clients"] = len(_subscriptions)
+    return result
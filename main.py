@@ -1,8 +1,11 @@
 import asyncio
+import json
 import logging
 import os
 import random
+import uuid
 import uvicorn
+from functools import partial
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
@@ -10,12 +13,22 @@ from aiogram.filters.command import Command
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
 from aiogram.exceptions import TelegramBadRequest
 from aiogram import BaseMiddleware
 from typing import Callable, Dict, Any, Awaitable
 
 import db
+import async_db
+import bans
+import fanout
+import outbox
+import refresh
+import scheduler
+import webhook
+import ordered
+import lobby_events
+import http_cache
 from app import app as fastapi_app
 
 # Для Railway и других платформ, которые ищут переменную 'app'
@@ -26,23 +39,72 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 BOT_TOKEN_2 = os.getenv("BOT_TOKEN_2") # Токен второго бота
 
+PORT = int(os.environ.get("PORT", 8000))
+# Если задан WEBHOOK_URL (https://домен), боты получают обновления через webhook
+# на этом же FastAPI-приложении вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    # id бота публичен: без секрета любой может слать на маршрут поддельные обновления
+    raise RuntimeError("WEBHOOK_SECRET is required when WEBHOOK_URL is set")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1)) # Воркеры uvicorn в режиме webhook
+# uvicorn вызывает shutdown приложения только после закрытия соединений, а SSE-потоки
+# Mini App сами не закрываются: через SHUTDOWN_GRACE секунд они прерываются
+SHUTDOWN_GRACE = int(os.getenv("SHUTDOWN_GRACE", 5))
+STARTUP_LOCK_TTL = 60
+# Id развертывания: восстановление лобби из БД выполняется один раз на развертывание.
+# Сгенерированный id попадает в окружение и наследуется воркерами uvicorn, поэтому
+# перезапущенный или поздно стартовавший воркер не затрет живые лобби в Redis
+DEPLOY_ID = os.getenv("DEPLOY_ID") or os.environ.setdefault("BOOT_ID", uuid.uuid4().hex)
+
+# Каналы для обязательной подписки (бот должен быть в них админом)
+CHANNEL_ID = os.getenv("CHANNEL_ID")
+CHANNEL_ID_2 = os.getenv("CHANNEL_ID_2")
+CHANNEL_URL = os.getenv("CHANNEL_URL")
+CHANNEL_URL_2 = os.getenv("CHANNEL_URL_2")
+# Сколько секунд помнить результат проверки подписки: подписан / не подписан
+SUB_CACHE_TTL = int(os.getenv("SUB_CACHE_TTL", 600))
+SUB_NEGATIVE_TTL = int(os.getenv("SUB_NEGATIVE_TTL", 30))
+
 ADMINS = [1562788488, 8565678796] # Замените на реальные ID админов
 
 # Инициализация ботов
 bot = Bot(token=BOT_TOKEN)
 bot2 = Bot(token=BOT_TOKEN_2) if BOT_TOKEN_2 else None
-
-dp = Dispatcher(storage=MemoryStorage())
-dp2 = Dispatcher(storage=MemoryStorage()) if bot2 else None
-
-async def main():
-    db.init_db()
-    
+# Все исходящие сообщения обоих ботов идут через общую очередь с лимитами.
+# В режиме webhook общий лимит бота делится между воркерами uvicorn
+outbox.setup(bot, bot2, processes=WEB_CONCURRENCY if WEBHOOK_URL else 1)
+
+# FSM (регистрация, поддержка, админ-действия) хранится в том же Redis, что и state.py:
+# диалоги переживают редеплой, а несколько воркеров бота видят одно состояние.
+# Ключи содержат id бота, поэтому диалоги двух ботов не пересекаются
+import state as app_state
+FSM_TTL = int(os.getenv("FSM_TTL", 86400)) # Брошенный диалог живет сутки
+fsm_storage = RedisStorage(
+    redis=app_state.r,
+    key_builder=DefaultKeyBuilder(with_bot_id=True),
+    state_ttl=FSM_TTL,
+    data_ttl=FSM_TTL,
+    json_dumps=partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
+)
+
+# Межпроцессная блокировка по ключу FSM (lock-ключ в Redis): в webhook-режиме с
+# несколькими воркерами обновления одного игрока могут попасть в разные процессы,
+# и без нее их обработчики читали бы и меняли состояние FSM одновременно
+fsm_isolation = fsm_storage.create_isolation()
+dp = Dispatcher(storage=fsm_storage, events_isolation=fsm_isolation)
+dp2 = Dispatcher(storage=fsm_storage, events_isolation=fsm_isolation) if bot2 else None
+# Обновления одного игрока обрабатываются по порядку, разных игроков - параллельно
+ordered.setup(dp, dp2)
+
+async def restore_runtime_state():
     # Восстановление состояния лобби из БД при запуске в Redis
     import state
-    lobby_members = db.get_all_lobby_members()
-    for uid, mode, lid in lobby_members:
-        user = db.get_user(uid)
+    lobby_members = await async_db.get_all_lobby_members()
+    restored = {}
+    for mode, lid, uid in lobby_members:
+        user = await async_db.get_user(uid)
         if user:
             lvl = db.get_level_by_elo(user[2])
             player_data = {
@@ -50,11 +112,46 @@ async def main():
                 "level": lvl, 
                 "game_id": user[0]
             }
-            await state.add_player_to_lobby(mode, lid, uid, player_data)
+            restored.setdefault((mode, lid), {})[str(uid)] = player_data
+    # Старые ключи (в том числе JSON-строки прежнего формата) заменяются составом из БД
+    await state.clear_lobbies()
+    for (mode, lid), players in restored.items():
+        await state.set_lobby_players(mode, lid, players)
     
+    # Зеркало лидерборда в Redis пересобирается из SQLite при каждом запуске
+    try:
+        count = await async_db.rebuild_leaderboard()
+        logging.info(f"Лидерборд пересобран: {count} игроков")
+    except Exception as e:
+        logging.error(f"Failed to rebuild leaderboard: {e}")
+
+def start_services():
+    # Фоновые службы процесса: очередь отправки и таймеры матчей
+    outbox.start()
+    # Таймауты матчей живут в Redis и переживают перезапуск
+    scheduler.register("accept", check_accept_timeout)
+    scheduler.register("ban", auto_ban_timer)
+    scheduler.register("pick", auto_pick_timer)
+    # Вход и выход из лобби - и из бота, и из Mini App - перерисовывают экраны и собирают матч
+    core.setup(on_changed=on_lobby_changed, on_full=on_lobby_full)
+    return asyncio.create_task(scheduler.run())
+
+async def stop_services(scheduler_task):
+    scheduler_task.cancel()
+    await asyncio.gather(scheduler_task, return_exceptions=True)
+    await ordered.stop()
+    await outbox.stop()
+    async_db.shutdown()
+
+async def main():
+    await async_db.init_db()
+    await restore_runtime_state()
+    # После работы в режиме webhook Telegram отклоняет getUpdates, пока webhook зарегистрирован
+    for b, _ in webhook_bots():
+        await b.delete_webhook()
+
     # Запуск ботов и FastAPI сервера параллельно
-    port = int(os.environ.get("PORT", 8000))
-    config = uvicorn.Config(fastapi_app, host="0.0.0.0", port=port, loop="asyncio")
+    config = uvicorn.Config(fastapi_app, host="0.0.0.0", port=PORT, loop="asyncio", timeout_graceful_shutdown=SHUTDOWN_GRACE)
     server = uvicorn.Server(config)
     
     tasks = [
@@ -66,7 +163,71 @@ async def main():
         logging.info("Запуск второго бота для синхронизации...")
         tasks.append(dp2.start_polling(bot2))
         
-    await asyncio.gather(*tasks)
+    scheduler_task = start_services()
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await stop_services(scheduler_task)
+
+# Режим webhook: обновления приходят на маршруты FastAPI, а запуск и остановка
+# служб привязаны к жизненному циклу приложения (в каждом воркере uvicorn)
+_webhook_services = []
+
+def webhook_bots():
+    bots = [(bot, dp)]
+    if dp2 and bot2:
+        bots.append((bot2, dp2))
+    return bots
+
+async def on_webhook_startup():
+    await async_db.init_db()
+    # Восстановление из БД - один раз на развертывание, регистрация webhook - при каждом запуске
+    # процесса. Блокировка не дает воркерам делать это одновременно и снимается сразу после работы
+    lock = await app_state.acquire_lock("startup", STARTUP_LOCK_TTL)
+    if lock:
+        try:
+            if not await app_state.is_restored(DEPLOY_ID):
+                await restore_runtime_state()
+                await app_state.mark_restored(DEPLOY_ID)
+            for b, d in webhook_bots():
+                await webhook.set_webhook(b, d, f"{WEBHOOK_URL}{WEBHOOK_PATH}/{b.id}", WEBHOOK_SECRET)
+        finally:
+            await app_state.release_lock("startup", lock)
+    _webhook_services.append(start_services())
+
+async def on_webhook_shutdown():
+    await webhook.drain()
+    while _webhook_services:
+        await stop_services(_webhook_services.pop())
+
+if WEBHOOK_URL:
+    for b, d in webhook_bots():
+        webhook.setup(fastapi_app, b, d, f"{WEBHOOK_PATH}/{b.id}", WEBHOOK_SECRET)
+    fastapi_app.router.add_event_handler("startup", on_webhook_startup)
+    fastapi_app.router.add_event_handler("shutdown", on_webhook_shutdown)
+
+class BanMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        # Единая проверка бана для всех сообщений и нажатий кнопок
+        if isinstance(event, (types.Message, types.CallbackQuery)) and event.from_user:
+            banned, ban_until = await bans.get_active_ban(event.from_user.id)
+            if banned:
+                text = f"❌ Вы заблокированы до {ban_until}." if ban_until else "❌ Вы заблокированы навсегда."
+                try:
+                    if isinstance(event, types.Message):
+                        await event.answer(text)
+                    else:
+                        await event.answer(text, show_alert=True)
+                except TelegramBadRequest:
+                    pass
+                return
+
+        return await handler(event, data)
 
 class SubscriptionMiddleware(BaseMiddleware):
     async def __call__(
@@ -135,12 +296,16 @@ class MenuMiddleware(BaseMiddleware):
                 
         return await handler(event, data)
 
+dp.message.middleware(BanMiddleware())
+dp.callback_query.middleware(BanMiddleware())
 dp.message.middleware(SubscriptionMiddleware())
 dp.callback_query.middleware(SubscriptionMiddleware())
 dp.message.middleware(MenuMiddleware())
 
 # Регистрация мидлварей для второго бота
 if dp2:
+    dp2.message.middleware(BanMiddleware())
+    dp2.callback_query.middleware(BanMiddleware())
     dp2.message.middleware(SubscriptionMiddleware())
     dp2.callback_query.middleware(SubscriptionMiddleware())
     dp2.message.middleware(MenuMiddleware())
@@ -154,6 +319,9 @@ import core
 MAP_LIST_2X2 = ["Sandstone", "Province", "Breeze", "Dune", "Zone 7", "Rust", "Hanami"]
 MAP_LIST_1X1 = ["Temple", "Yard", "Bridge", "Pool", "Desert", "Pipeline", "Cableway"]
 
+ACCEPT_TIMEOUT = 60 # Секунд на подтверждение матча
+TURN_TIMEOUT = 30 # Секунд на бан карты или пик игрока
+
 # Состояния регистрации
 class Registration(StatesGroup):
     waiting_for_game_id = State()
@@ -224,21 +392,15 @@ def main_menu_keyboard(user_id=None):
     ))
     return builder.as_markup(resize_keyboard=True, persistent=True)
 
-async def get_lobby_keyboard(user_id, mode, lobby_id):
+def build_lobby_keyboard(mode, lobby_id, players_count, in_lobby):
+    # Клавиатура лобби без обращения к Redis: для рассылки она собирается
+    # дважды (для участников и для остальных) и переиспользуется
     import state
     builder = InlineKeyboardBuilder()
-    players_in_lobby = await state.get_lobby_players(mode, lobby_id)
-    
-    if mode == "1x1":
-        max_players = 2
-    elif mode == "2x2":
-        max_players = 4
-    else: # 5x5
-        max_players = 10
     
-    if str(user_id) not in players_in_lobby:
+    if not in_lobby:
         builder.row(types.InlineKeyboardButton(
-            text=f"Войти в лобби {lobby_id} 🎮 ({len(players_in_lobby)}/{max_players})", 
+            text=f"Войти в лобби {lobby_id} 🎮 ({players_count}/{state.MAX_PLAYERS[mode]})", 
             callback_data=f"l_enter_{mode}_{lobby_id}"
         ))
     else:
@@ -250,6 +412,10 @@ async def get_lobby_keyboard(user_id, mode, lobby_id):
     builder.row(types.InlineKeyboardButton(text="⬅️ Назад к выбору лобби", callback_data=f"mode_{mode}"))
     return builder.as_markup()
 
+async def get_lobby_keyboard(user_id, mode, lobby_id):
+    players_in_lobby = await core.get_players(mode, lobby_id)
+    return build_lobby_keyboard(mode, lobby_id, len(players_in_lobby), str(user_id) in players_in_lobby)
+
 def get_mode_selection_keyboard():
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -262,34 +428,23 @@ def get_mode_selection_keyboard():
     return builder.as_markup()
 
 async def get_lobby_list_keyboard(mode):
-    import state
     builder = InlineKeyboardBuilder()
-    if mode == "1x1":
-        max_p = 2
-    elif mode == "2x2":
-        max_p = 4
-    else: # 5x5
-        max_p = 10
+    # Счетчики всех лобби режима одним запросом
+    snapshot = await core.get_snapshot(modes=[mode])
         
-    for lid in range(1, 11):
-        players = await state.get_lobby_players(mode, lid)
-        count = len(players)
+    for lobby in snapshot["modes"][mode]:
+        lid = lobby["id"]
         builder.row(types.InlineKeyboardButton(
-            text=f"Лобби №{lid} [{count}/{max_p}]", 
+            text=f"Лобби №{lid} [{lobby['players']}/{lobby['max']}]", 
             callback_data=f"view_l_{mode}_{lid}"
         ))
     builder.row(types.InlineKeyboardButton(text="⬅️ Назад к режимам", callback_data="back_to_modes"))
     return builder.as_markup()
 
-async def update_all_lobby_messages(mode, lobby_id):
+async def render_lobby_messages(mode, lobby_id):
     import state
-    players_in_lobby = await state.get_lobby_players(mode, lobby_id)
-    if mode == "1x1":
-        max_p = 2
-    elif mode == "2x2":
-        max_p = 4
-    else: # 5x5
-        max_p = 10
+    players_in_lobby = await core.get_players(mode, lobby_id)
+    max_p = state.MAX_PLAYERS[mode]
         
     status_text = f"📍 Режим: {mode} | Лобби №{lobby_id} ({len(players_in_lobby)}/{max_p})\n\nСписок игроков 🎮:\n"
     
@@ -299,78 +454,111 @@ async def update_all_lobby_messages(mode, lobby_id):
         for uid, data in players_in_lobby.items():
             status_text += f"👤 {data['nickname']} | Lvl: {data['level']}\n"
     
-    # Обновляем сообщения у всех, кто смотрит ИМЕННО ЭТО лобби
-    all_viewers = await state.get_all_viewers()
-    dead_viewers = []
-    for uid, data in all_viewers.items():
-        if data.get("mode") == mode and data.get("lobby_id") == lobby_id:
-            try:
-                await bot.edit_message_text(
-                    text=status_text,
-                    chat_id=data['chat_id'],
-                    message_id=data['message_id'],
-                    reply_markup=await get_lobby_keyboard(uid, mode, lobby_id)
-                )
-            except TelegramBadRequest as e:
-                if "message is not modified" in str(e): continue
-                dead_viewers.append(uid)
-            except Exception:
-                dead_viewers.append(uid)
+    # Обновляем сообщения у всех, кто смотрит ИМЕННО ЭТО лобби.
+    # Состав прочитан один раз, клавиатур всего две - для участников и для остальных
+    keyboard_in = build_lobby_keyboard(mode, lobby_id, len(players_in_lobby), True)
+    keyboard_out = build_lobby_keyboard(mode, lobby_id, len(players_in_lobby), False)
+    viewers = await state.get_lobby_viewers(mode, lobby_id)
+    calls = {
+        uid: partial(
+            bot.edit_message_text,
+            text=status_text,
+            chat_id=data['chat_id'],
+            message_id=data['message_id'],
+            reply_markup=keyboard_in if str(uid) in players_in_lobby else keyboard_out
+        )
+        for uid, data in viewers.items()
+    }
+    report = await fanout.broadcast(f"lobby:{mode}:{lobby_id}", calls)
             
-    for uid in dead_viewers:
+    for uid in report["dead"]:
         await state.remove_viewer(uid)
 
-async def update_lobby_list_for_all(mode):
+async def render_lobby_list(mode):
     import state
     # Обновляем список лобби для тех, кто находится на экране выбора лобби этого режима
-    all_viewers = await state.get_all_viewers()
-    for uid, data in all_viewers.items():
-        if data.get("mode") == mode and data.get("lobby_id") is None:
-            try:
-                await bot.edit_message_text(
-                    text=f"Выбран режим: {mode}. Выберите свободное лобби:",
-                    chat_id=data['chat_id'],
-                    message_id=data['message_id'],
-                    reply_markup=await get_lobby_list_keyboard(mode)
-                )
-            except: pass
+    viewers = await state.get_lobby_viewers(mode, None)
+    if not viewers:
+        return
+    keyboard = await get_lobby_list_keyboard(mode)
+    calls = {
+        uid: partial(
+            bot.edit_message_text,
+            text=f"Выбран режим: {mode}. Выберите свободное лобби:",
+            chat_id=data['chat_id'],
+            message_id=data['message_id'],
+            reply_markup=keyboard
+        )
+        for uid, data in viewers.items()
+    }
+    await fanout.broadcast(f"list:{mode}", calls)
+
+# Обновления экранов откладываются и объединяются: серия входов и выходов
+# за LOBBY_REFRESH_WINDOW перерисовывает каждый экран один раз
+async def update_all_lobby_messages(mode, lobby_id):
+    refresh.schedule(("lobby", mode, lobby_id), partial(render_lobby_messages, mode, lobby_id))
+
+async def update_lobby_list_for_all(mode):
+    refresh.schedule(("list", mode), partial(render_lobby_list, mode))
+
+async def on_lobby_changed(mode, lobby_id):
+    await update_all_lobby_messages(mode, lobby_id)
+    await update_lobby_list_for_all(mode)
+
+async def on_lobby_full(mode, lobby_id):
+    # Небольшая задержка перед подтверждением, чтобы пользователи увидели заполнение
+    await asyncio.sleep(0.5)
+    await request_match_accept(mode, lobby_id)
+
+SUBSCRIBED_STATUSES = ["member", "administrator", "creator"]
+
+async def check_subscription(user_id: int, use_cache: bool = True) -> bool:
+    import state
+    channels = [c for c in (CHANNEL_ID, CHANNEL_ID_2) if c]
+    if not channels:
+        return True
+
+    if use_cache:
+        try:
+            cached = await state.get_cached_subscription(user_id)
+            if cached is not None:
+                return cached
+        except Exception as e:
+            logging.error(f"Subscription cache read failed: {e}")
 
-async def check_subscription(user_id: int) -> bool:
     try:
-        # Проверка первого канала
-        member1 = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        is_sub1 = member1.status in ["member", "administrator", "creator"]
-        
-        # Проверка второго канала
-        member2 = await bot.get_chat_member(chat_id=CHANNEL_ID_2, user_id=user_id)
-        is_sub2 = member2.status in ["member", "administrator", "creator"]
-        
-        return is_sub1 and is_sub2
+        # Проверяем оба канала параллельно
+        members = await asyncio.gather(*(bot.get_chat_member(chat_id=c, user_id=user_id) for c in channels))
+        subscribed = all(m.status in SUBSCRIBED_STATUSES for m in members)
+        ttl = SUB_CACHE_TTL if subscribed else SUB_NEGATIVE_TTL
     except Exception:
         # Если бот не админ в каком-то канале или канал не найден, 
-        # для безопасности считаем что подписан, чтобы не блокировать всех
-        return True
+        # для безопасности считаем что подписан, чтобы не блокировать всех.
+        # Такой ответ кэшируем ненадолго, чтобы не долбить API при каждом клике
+        subscribed = True
+        ttl = SUB_NEGATIVE_TTL
+
+    try:
+        await state.set_cached_subscription(user_id, subscribed, ttl)
+    except Exception as e:
+        logging.error(f"Subscription cache write failed: {e}")
+    return subscribed
+
+async def on_channel_member_update(update: types.ChatMemberUpdated):
+    # Бот - админ канала и получает изменения участников: сбрасываем кэш,
+    # чтобы отписка или подписка учитывалась сразу, а не через TTL
+    import state
+    if str(update.chat.id) not in (CHANNEL_ID, CHANNEL_ID_2) and (
+            not update.chat.username or f"@{update.chat.username}" not in (CHANNEL_ID, CHANNEL_ID_2)):
+        return
+    await state.invalidate_subscription(update.new_chat_member.user.id)
+
+dp.chat_member.register(on_channel_member_update)
+if dp2:
+    dp2.chat_member.register(on_channel_member_update)
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == message.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        # Проверка временного бана
-        ban_until_str = user_db_data[6]
-        if ban_until_str:
-            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() < ban_until:
-                await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
-                return
-            else:
-                # Время бана истекло
-                db.set_ban_status(message.from_user.id, False)
-        else:
-            await message.answer("❌ Вы заблокированы навсегда.")
-            return
-
     # Проверка подписки
     if not await check_subscription(message.from_user.id):
         builder = InlineKeyboardBuilder()
@@ -401,7 +589,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data == "check_sub")
 async def handle_check_sub(callback: types.CallbackQuery, state: FSMContext):
-    if await check_subscription(callback.from_user.id):
+    # Пользователь говорит, что только что подписался - кэш не используем
+    if await check_subscription(callback.from_user.id, use_cache=False):
         try: await callback.answer("Подписка подтверждена! ✅")
         except TelegramBadRequest: pass
         await cmd_start(callback.message, state)
@@ -457,29 +646,12 @@ async def process_nickname(message: types.Message, state: FSMContext):
         await message.answer("Никнейм от 2 до 20 символов:")
         return
     user_data = await state.get_data()
-    db.add_user(message.from_user.id, user_data['game_id'], nickname)
+    await async_db.add_user(message.from_user.id, user_data['game_id'], nickname)
     await state.clear()
     await message.answer(f"Регистрация завершена! 🎉\nНик: {nickname}\nID: {user_data['game_id']}\nLvl: 4", reply_markup=main_menu_keyboard(message.from_user.id))
 
 @dp.message(F.text == "Профиль 👤")
 async def profile(message: types.Message):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == message.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        # Проверка временного бана
-        ban_until_str = user_db_data[6]
-        if ban_until_str:
-            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() < ban_until:
-                await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
-                return
-            else:
-                db.set_ban_status(message.from_user.id, False)
-        else:
-            await message.answer("❌ Вы заблокированы.")
-            return
-
     # Проверка подписки
     if not await check_subscription(message.from_user.id):
         builder = InlineKeyboardBuilder()
@@ -505,23 +677,6 @@ async def profile(message: types.Message):
 
 @dp.message(F.text == "Поиск матча 🔍")
 async def find_match(message: types.Message):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == message.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        # Проверка временного бана
-        ban_until_str = user_db_data[6]
-        if ban_until_str:
-            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() < ban_until:
-                await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
-                return
-            else:
-                db.set_ban_status(message.from_user.id, False)
-        else:
-            await message.answer("❌ Вы заблокированы.")
-            return
-
     # Проверка подписки
     if not await check_subscription(message.from_user.id):
         builder = InlineKeyboardBuilder()
@@ -548,14 +703,6 @@ async def find_match(message: types.Message):
 
 @dp.callback_query(F.data == "back_to_modes")
 async def back_to_modes(callback: types.CallbackQuery):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == callback.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        try: await callback.answer("❌ Вы заблокированы.", show_alert=True)
-        except TelegramBadRequest: pass
-        return
-
     try: await callback.answer()
     except TelegramBadRequest: pass
 
@@ -572,13 +719,6 @@ async def back_to_modes(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("mode_"))
 async def select_mode(callback: types.CallbackQuery):
     await callback.answer()
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == callback.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        await callback.answer("❌ Вы заблокированы.", show_alert=True)
-        return
-
     mode = callback.data.split("_")[1]
     await callback.message.edit_text(
         f"Выбран режим: {mode}. Выберите свободное лобби:",
@@ -591,13 +731,6 @@ async def select_mode(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("view_l_"))
 async def view_lobby(callback: types.CallbackQuery):
     await callback.answer()
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == callback.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        await callback.answer("❌ Вы заблокированы.", show_alert=True)
-        return
-
     try:
         import state
         _, _, mode, lobby_id = callback.data.split("_")
@@ -606,7 +739,7 @@ async def view_lobby(callback: types.CallbackQuery):
         # Обновляем инфо о зрителе
         await state.set_viewer(callback.from_user.id, mode, lobby_id, callback.message.message_id, callback.message.chat.id)
         
-        players_in_lobby = await state.get_lobby_players(mode, lobby_id)
+        players_in_lobby = await core.get_players(mode, lobby_id)
         if mode == "1x1":
             max_players = 2
         elif mode == "2x2":
@@ -633,13 +766,6 @@ async def lobby_enter_callback(callback: types.CallbackQuery):
     # Принудительно подтверждаем callback сразу для отзывчивости
     await callback.answer()
     
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == callback.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        await callback.message.answer("❌ Вы заблокированы.")
-        return
-
     _, _, mode, lobby_id = callback.data.split("_")
     lobby_id = int(lobby_id)
     user_id = callback.from_user.id
@@ -649,37 +775,32 @@ async def lobby_enter_callback(callback: types.CallbackQuery):
     await state.set_viewer(user_id, mode, lobby_id, callback.message.message_id, callback.message.chat.id)
     
     import core
+    # Экраны лобби (в том числе того, из которого игрок вышел) и сбор матча - в core через on_lobby_*
     result = await core.join_lobby(user_id, mode, lobby_id)
     
     if result["status"] == "success":
-        await update_all_lobby_messages(mode, lobby_id)
-        await update_lobby_list_for_all(mode)
-        
-        if result.get("full"):
-            # Небольшая задержка перед подтверждением, чтобы пользователи увидели заполнение
-            await asyncio.sleep(0.5)
-            await request_match_accept(mode, lobby_id)
-        else:
+        if not result.get("full"):
             await callback.message.answer(f"✅ Вы вошли в лобби №{lobby_id} ({mode})")
     else:
         await callback.answer(result.get("message", "Ошибка"), show_alert=True)
 
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def request_match_accept(mode, lobby_id):
     import state
-    players_in_lobby = await state.get_lobby_players(mode, lobby_id)
+    # Забираем состав и очищаем лобби в Redis одной транзакцией
+    players_in_lobby = await state.take_lobby_players(mode, lobby_id)
     if not players_in_lobby:
         return
         
     players = list(players_in_lobby.items())
     player_ids = [int(uid) for uid in players_in_lobby.keys()]
     
-    # Удаляем участников лобби из БД и Redis при создании матча
+    # Удаляем участников лобби из БД при создании матча
     for uid in player_ids:
-        db.remove_lobby_member(uid)
-        await state.remove_player_from_lobby(mode, lobby_id, uid)
+        await async_db.remove_lobby_member(uid)
         await state.remove_viewer(uid)
     
-    match_num = db.create_match(mode, player_ids)
+    match_num = await async_db.create_match(mode, player_ids)
     
     match_data = {
         "players": players,
@@ -693,18 +814,15 @@ async def request_match_accept(mode, lobby_id):
     builder = InlineKeyboardBuilder()
     builder.row(types.InlineKeyboardButton(text="Принять ✅", callback_data=f"accept_{match_num}"))
     
-    for uid_str, _ in players:
-        uid = int(uid_str)
-        try:
-            msg = await bot.send_message(uid, f"🔔 Игра {mode} найдена! Подтвердите участие (Матч №{match_num})\nУ вас есть 60 секунд.", reply_markup=builder.as_markup())
-            match_data["messages"][str(uid)] = msg.message_id
-        except: pass
+    text = f"🔔 Игра {mode} найдена! Подтвердите участие (Матч №{match_num})\nУ вас есть 60 секунд."
+    report = await fanout.notify(f"accept:{match_num}", bot, {int(uid_str): text for uid_str, _ in players}, reply_markup=builder.as_markup())
+    match_data["messages"] = {str(uid): msg_id for uid, msg_id in report["message_ids"].items()}
     
     await state.set_match(match_num, match_data, pending=True)
-    asyncio.create_task(check_accept_timeout(match_num))
+    await scheduler.schedule("accept", match_num, ACCEPT_TIMEOUT, match_num)
 
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def check_accept_timeout(match_num):
-    await asyncio.sleep(60) 
     import state
     match = await state.get_match(match_num, pending=True)
     if match:
@@ -720,15 +838,15 @@ async def check_accept_timeout(match_num):
         for p_uid_str, p_data in not_accepted:
             p_uid = int(p_uid_str)
             # Инкремент предупреждений
-            count = db.increment_missed_games(p_uid)
+            count = await async_db.increment_missed_games(p_uid)
             
             try:
                 if count >= 3:
                     # Бан на 30 минут
                     ban_until = datetime.now() + timedelta(minutes=30)
                     until_str = ban_until.strftime("%Y-%m-%d %H:%M:%S")
-                    db.set_ban_status(p_uid, True, until_str)
-                    db.reset_missed_games(p_uid)
+                    await bans.set_ban_status(p_uid, True, until_str)
+                    await async_db.reset_missed_games(p_uid)
                     await bot.send_message(p_uid, f"❌ Вы не подтвердили игру (3/3). Бан на 30 минут до {until_str}.")
                 else:
                     await bot.send_message(p_uid, f"⚠️ Вы не подтвердили игру! Предупреждение: {count}/3. При 3/3 — бан на 30 минут.")
@@ -742,28 +860,18 @@ async def check_accept_timeout(match_num):
             # Возвращаем их в лобби (или просто уведомляем, что они остаются в очереди)
             # Находим свободное лобби для них или создаем видимость, что они там
             
-            target_lobby_id = 1
-            for lid in range(1, 11):
-                p_in_l = await state.get_lobby_players(mode, lid)
-                if len(p_in_l) == 0:
-                    target_lobby_id = lid
-                    break
+            target_lobby_id = await core.find_empty_lobby(mode) or 1
             
             for p_uid_str, p_data in accepted_players:
                 p_uid = int(p_uid_str)
                 try:
-                    # Возвращаем в Redis
-                    await state.add_player_to_lobby(mode, target_lobby_id, p_uid, p_data)
-                    # Возвращаем в БД
-                    db.add_lobby_member(mode, target_lobby_id, p_uid)
+                    # Возвращаем в Redis и в БД, экраны лобби обновит core
+                    await core.return_to_lobby(p_uid, mode, target_lobby_id, p_data)
                     
                     await bot.edit_message_text(f"Матч отменен: не все игроки подтвердили участие.\nВы возвращены в лобби №{target_lobby_id}.", chat_id=p_uid, message_id=match["messages"].get(str(p_uid)))
                 except: pass
-            
-            await update_all_lobby_messages(mode, target_lobby_id)
-            await update_lobby_list_for_all(mode)
 
-        db.cancel_match(match_num)
+        await async_db.cancel_match(match_num)
         await state.delete_match(match_num, pending=True)
 
 @dp.callback_query(F.data.startswith("accept_"))
@@ -777,18 +885,18 @@ async def handle_accept(callback: types.CallbackQuery):
     match = await state.get_match(match_num, pending=True)
     if not match:
         # Если в Redis нет (после перезагрузки или истечения TTL), проверяем БД
-        match_db = db.get_pending_match(match_num)
+        match_db = await async_db.get_pending_match(match_num)
         if not match_db:
             await callback.answer("Матч уже отменен, не существует или уже начат.", show_alert=True)
             return
             
         # Восстанавливаем
-        players_db = db.get_match_players(match_num)
+        players_db = await async_db.get_match_players(match_num)
         restored_players = []
         accepted_list = []
         for p in players_db:
             uid, nick, elo, lvl, accepted = p
-            u_full = db.get_user(uid)
+            u_full = await async_db.get_user(uid)
             gid = u_full[0] if u_full else str(uid)
             p_data = {"nickname": nick, "level": lvl, "game_id": gid}
             restored_players.append((str(uid), p_data))
@@ -807,7 +915,7 @@ async def handle_accept(callback: types.CallbackQuery):
         return
         
     match["accepted"].append(user_id)
-    db.accept_match_player(match_num, user_id)
+    await async_db.accept_match_player(match_num, user_id)
     await state.set_match(match_num, match, pending=True)
     
     try:
@@ -819,8 +927,10 @@ async def handle_accept(callback: types.CallbackQuery):
         players = match["players"]
         mode = match["mode"]
         await state.delete_match(match_num, pending=True)
+        await scheduler.cancel("accept", match_num)
         await start_match_setup(match_num, players, mode)
 
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def start_match_setup(match_num, players, mode):
     random.shuffle(players)
     import state
@@ -842,8 +952,8 @@ async def start_match_setup(match_num, players, mode):
             "message_ids": {}
         }
         await state.set_match(match_num, match_data, pending=False)
-        for uid_str, _ in players:
-            await bot.send_message(int(uid_str), f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 1x1 №{match_num})\n\nНачинаем бан карт.")
+        text = f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 1x1 №{match_num})\n\nНачинаем бан карт."
+        await fanout.notify(f"start:{match_num}", bot, {int(uid_str): text for uid_str, _ in players})
         await send_map_selection(match_num)
     elif mode == "2x2":
         # Режим 2x2 - стандартная логика с капитанами
@@ -865,8 +975,8 @@ async def start_match_setup(match_num, players, mode):
             "message_ids": {}
         }
         await state.set_match(match_num, match_data, pending=False)
-        for uid_str, _ in players:
-            await bot.send_message(int(uid_str), f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 2x2 №{match_num})\nКапитан CT: {cap_ct[1]['nickname']}\nКапитан T: {cap_t[1]['nickname']}\n\nНачинаем бан карт. Первые банят CT.")
+        text = f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 2x2 №{match_num})\nКапитан CT: {cap_ct[1]['nickname']}\nКапитан T: {cap_t[1]['nickname']}\n\nНачинаем бан карт. Первые банят CT."
+        await fanout.notify(f"start:{match_num}", bot, {int(uid_str): text for uid_str, _ in players})
         await send_map_selection(match_num)
     else: # 5x5
         # Режим 5x5 - логика как в 2x2, но мап-пул такой же (по условию)
@@ -888,12 +998,12 @@ async def start_match_setup(match_num, players, mode):
             "message_ids": {}
         }
         await state.set_match(match_num, match_data, pending=False)
-        for uid_str, _ in players:
-            await bot.send_message(int(uid_str), f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 5x5 №{match_num})\nКапитан CT: {cap_ct[1]['nickname']}\nКапитан T: {cap_t[1]['nickname']}\n\nНачинаем бан карт. Первые банят CT.")
+        text = f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 5x5 №{match_num})\nКапитан CT: {cap_ct[1]['nickname']}\nКапитан T: {cap_t[1]['nickname']}\n\nНачинаем бан карт. Первые банят CT."
+        await fanout.notify(f"start:{match_num}", bot, {int(uid_str): text for uid_str, _ in players})
         await send_map_selection(match_num)
 
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def auto_ban_timer(match_id, turn_at_start):
-    await asyncio.sleep(30)
     import state
     match = await state.get_match(match_id, pending=False)
     if not match: return
@@ -912,24 +1022,21 @@ async def auto_ban_timer(match_id, turn_at_start):
         await send_map_selection(match_id)
     else:
         match["final_map"] = match["maps"][0]
-        for uid_str, msg_id in match.get("message_ids", {}).items():
-            try: await bot.delete_message(chat_id=int(uid_str), message_id=msg_id)
-            except: pass
-        match["message_ids"] = {}
+        await clear_match_step_messages(match_id, match)
         
         if match.get("mode") in ["2x2", "5x5"]:
             match["phase"] = "pick"
             match["turn"] = "t"
             await state.set_match(match_id, match, pending=False)
-            for uid_str, _ in match["players"]:
-                await bot.send_message(int(uid_str), f"Время вышло! Карта определена автоматически: {match['final_map']}!\nПереходим к выбору игроков.")
+            text = f"Время вышло! Карта определена автоматически: {match['final_map']}!\nПереходим к выбору игроков."
+            await fanout.notify(f"map:{match_id}", bot, {int(uid_str): text for uid_str, _ in match["players"]})
             await send_player_selection(match_id)
         else:
             await state.set_match(match_id, match, pending=False)
             await finish_match_setup(match_id)
 
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def auto_pick_timer(match_id, turn_at_start):
-    await asyncio.sleep(30)
     import state
     match = await state.get_match(match_id, pending=False)
     if not match: return
@@ -945,13 +1052,47 @@ async def auto_pick_timer(match_id, turn_at_start):
         await state.set_match(match_id, match, pending=False)
         await send_player_selection(match_id)
     else:
-        for uid_str, msg_id in match.get("message_ids", {}).items():
-            try: await bot.delete_message(chat_id=int(uid_str), message_id=msg_id)
-            except: pass
-        match["message_ids"] = {}
+        await clear_match_step_messages(match_id, match)
         await state.set_match(match_id, match, pending=False)
         await finish_match_setup(match_id)
 
+async def _edit_or_send_step(chat_id, message_id, text, markup):
+    # Правим сообщение прошлого хода, а если нельзя - отправляем новое. Возвращает id сообщения
+    if message_id:
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=markup)
+            return message_id
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return message_id
+        except Exception:
+            pass
+    msg = await bot.send_message(chat_id, text, reply_markup=markup)
+    return msg.message_id
+
+async def show_match_step(name, match, steps):
+    # Текущий этап бана/пика всем игрокам параллельно; steps - {uid: (текст, клавиатура)}.
+    # id сообщений сохраняются в match["message_ids"] для правок на следующем ходу
+    message_ids = match.setdefault("message_ids", {})
+    calls = {
+        uid: partial(_edit_or_send_step, uid, message_ids.get(str(uid)), text, markup)
+        for uid, (text, markup) in steps.items()
+    }
+    report = await fanout.broadcast(name, calls, level=outbox.PRIORITY_MATCH)
+    for uid, msg_id in report["results"].items():
+        message_ids[str(uid)] = msg_id
+    return report
+
+async def clear_match_step_messages(match_id, match):
+    # Удаляем сообщения этапа бана/пика у всех игроков перед следующей фазой
+    calls = {
+        int(uid_str): partial(bot.delete_message, chat_id=int(uid_str), message_id=msg_id)
+        for uid_str, msg_id in match.get("message_ids", {}).items()
+    }
+    await fanout.broadcast(f"clear:{match_id}", calls, level=outbox.PRIORITY_MATCH)
+    match["message_ids"] = {}
+
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def send_map_selection(match_id):
     import state
     match = await state.get_match(match_id, pending=False)
@@ -979,31 +1120,18 @@ async def send_map_selection(match_id):
         
     text = f"⏳ У вас 30 секунд!\nЭтап: БАН КАРТ\nХод {turn_text}\nКарты в пуле: {', '.join(match['maps'])}"
     
-    # Запускаем таймер авто-бана
-    asyncio.create_task(auto_ban_timer(match_id, match['turn']))
+    # Таймер авто-бана: новый ход переносит срок того же события
+    await scheduler.schedule("ban", match_id, TURN_TIMEOUT, match_id, match['turn'])
     
+    markup = builder.as_markup()
+    steps = {}
     for uid_str, _ in match['players']:
         uid = int(uid_str)
-        markup = builder.as_markup() if uid == current_turn_uid else None
-        msg_text = text if uid == current_turn_uid else f"{text}\n(Ожидание хода противника)"
-        
-        if str(uid) in match.get("message_ids", {}):
-            try:
-                await bot.edit_message_text(
-                    chat_id=uid,
-                    message_id=match["message_ids"][str(uid)],
-                    text=msg_text,
-                    reply_markup=markup
-                )
-            except:
-                # Если сообщение нельзя редактировать, отправляем новое
-                new_msg = await bot.send_message(uid, msg_text, reply_markup=markup)
-                match["message_ids"][str(uid)] = new_msg.message_id
+        if uid == current_turn_uid:
+            steps[uid] = (text, markup)
         else:
-            new_msg = await bot.send_message(uid, msg_text, reply_markup=markup)
-            if "message_ids" not in match: match["message_ids"] = {}
-            match["message_ids"][str(uid)] = new_msg.message_id
-            
+            steps[uid] = (f"{text}\n(Ожидание хода противника)", None)
+    await show_match_step(f"bans:{match_id}", match, steps)
     await state.set_match(match_id, match, pending=False)
 
 @dp.callback_query(F.data.startswith("ban_"))
@@ -1037,24 +1165,23 @@ async def handle_ban(callback: types.CallbackQuery):
         await send_map_selection(match_id)
     else:
         match['final_map'] = match['maps'][0]
+        await scheduler.cancel("ban", match_id)
         # Очищаем старые сообщения перед переходом к следующей фазе
-        for uid_str, msg_id in match.get("message_ids", {}).items():
-            try: await bot.delete_message(chat_id=int(uid_str), message_id=msg_id)
-            except: pass
-        match["message_ids"] = {}
+        await clear_match_step_messages(match_id, match)
         
         if match.get("mode") in ["2x2", "5x5"]:
             match['phase'] = "pick"
             match['turn'] = "t"
             await state.set_match(match_id, match, pending=False)
-            for uid_str, _ in match['players']:
-                await bot.send_message(int(uid_str), f"Карта определена: {match['final_map']}!\nПереходим к выбору игроков. Первые выбирают T.")
+            text = f"Карта определена: {match['final_map']}!\nПереходим к выбору игроков. Первые выбирают T."
+            await fanout.notify(f"map:{match_id}", bot, {int(uid_str): text for uid_str, _ in match['players']})
             await send_player_selection(match_id)
         else:
             # В 1x1 сразу финиш
             await state.set_match(match_id, match, pending=False)
             await finish_match_setup(match_id)
 
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def send_player_selection(match_id):
     import state
     match = await state.get_match(match_id, pending=False)
@@ -1068,29 +1195,18 @@ async def send_player_selection(match_id):
     text = f"⏳ У вас 30 секунд!\nЭтап: ПИК ИГРОКОВ\nХод капитана {'CT' if match['turn'] == 'ct' else 'T'}\nДоступны: {', '.join(avail_nicks)}"
     current_cap = int(match['captains'][match['turn']])
     
-    # Запускаем таймер авто-пика
-    asyncio.create_task(auto_pick_timer(match_id, match['turn']))
+    # Таймер авто-пика: новый ход переносит срок того же события
+    await scheduler.schedule("pick", match_id, TURN_TIMEOUT, match_id, match['turn'])
     
+    markup = builder.as_markup()
+    steps = {}
     for uid_str, _ in match['players']:
         uid = int(uid_str)
-        markup = builder.as_markup() if uid == current_cap else None
-        msg_text = text if uid == current_cap else f"{text}\n(Ожидание хода капитана)"
-        
-        if str(uid) in match.get("message_ids", {}):
-            try:
-                await bot.edit_message_text(
-                    chat_id=uid,
-                    message_id=match["message_ids"][str(uid)],
-                    text=msg_text,
-                    reply_markup=markup
-                )
-            except:
-                new_msg = await bot.send_message(uid, msg_text, reply_markup=markup)
-                match["message_ids"][str(uid)] = new_msg.message_id
+        if uid == current_cap:
+            steps[uid] = (text, markup)
         else:
-            new_msg = await bot.send_message(uid, msg_text, reply_markup=markup)
-            match["message_ids"][str(uid)] = new_msg.message_id
-            
+            steps[uid] = (f"{text}\n(Ожидание хода капитана)", None)
+    await show_match_step(f"picks:{match_id}", match, steps)
     await state.set_match(match_id, match, pending=False)
 
 @dp.callback_query(F.data.startswith("pick_"))
@@ -1118,14 +1234,13 @@ async def handle_pick(callback: types.CallbackQuery):
         await state.set_match(match_id, match, pending=False)
         await send_player_selection(match_id)
     else:
+        await scheduler.cancel("pick", match_id)
         # Очистка сообщений перед финалом
-        for uid_str, msg_id in match.get("message_ids", {}).items():
-            try: await bot.delete_message(chat_id=int(uid_str), message_id=msg_id)
-            except: pass
-        match["message_ids"] = {}
+        await clear_match_step_messages(match_id, match)
         await state.set_match(match_id, match, pending=False)
         await finish_match_setup(match_id)
 
+@outbox.prioritized(outbox.PRIORITY_MATCH)
 async def finish_match_setup(match_id):
     import state
     match = await state.get_match(match_id, pending=False)
@@ -1153,16 +1268,11 @@ async def finish_match_setup(match_id):
         f"📉 За поражение: -{match['elo_gain']} ELO\n\n"
         f"⚠️ Напоминание: Ваши никнеймы в игре ДОЛЖЕНЫ совпадать с никнеймами в боте!"
     )
-    for uid_str, _ in match['players']:
-        await bot.send_message(int(uid_str), text, reply_markup=builder.as_markup())
-    
-    # Отправка того же сообщения админам (если они не игроки в этом матче)
-    player_ids = [p[0] for p in match['players']]
+    # Игрокам и админам (если они не игроки в этом матче) одно и то же сообщение
+    recipients = {int(uid_str): text for uid_str, _ in match['players']}
     for admin_id in ADMINS:
-        if str(admin_id) not in player_ids:
-            try:
-                await bot.send_message(admin_id, text, reply_markup=builder.as_markup())
-            except: pass
+        recipients.setdefault(admin_id, text)
+    await fanout.notify(f"ready:{match_id}", bot, recipients, reply_markup=builder.as_markup())
     
     # Сохраняем финальное состояние матча в Redis (оно будет доступно для скриншотов)
     await state.set_match(match_id, match, pending=False)
@@ -1346,30 +1456,33 @@ async def admin_confirm_win(callback: types.CallbackQuery):
         return
         
     elo_gain = match['elo_gain']
-    
-    # Начисляем/вычитаем ELO
+
+    # Начисляем/вычитаем ELO всем игрокам одной транзакцией
+    winners = [int(p[0]) for team_name, players in match['teams'].items() if team_name == winner_team for p in players]
+    losers = [int(p[0]) for team_name, players in match['teams'].items() if team_name != winner_team for p in players]
+    if not await async_db.settle_match(match_id, winners, losers, elo_gain):
+        try: await callback.answer("Этот матч уже подтвержден.", show_alert=True)
+        except TelegramBadRequest: pass
+        return
+
+    results = {}
     for team_name, players in match['teams'].items():
         is_win = (team_name == winner_team)
         change = elo_gain if is_win else -elo_gain
+        result_text = "ПОБЕДА! 🎉" if is_win else "ПОРАЖЕНИЕ... 📉"
         for p_uid_str, p_data in players:
-            p_uid = int(p_uid_str)
-            db.update_elo(p_uid, change, is_win)
-            try:
-                result_text = "ПОБЕДА! 🎉" if is_win else "ПОРАЖЕНИЕ... 📉"
-                await bot.send_message(p_uid, f"🔔 Результат матча №{match_id} подтвержден!\n\nРезультат: {result_text}\nИзменение ELO: {change:+}")
-            except: pass
+            results[int(p_uid_str)] = f"🔔 Результат матча №{match_id} подтвержден!\n\nРезультат: {result_text}\nИзменение ELO: {change:+}"
+    await fanout.notify(f"result:{match_id}", bot, results)
             
     # Синхронизация: удаляем кнопки у всех админов
     admin_msgs = await app_state.get_data(f"admin_msgs:{match_id}")
     if admin_msgs:
-        for admin_id_str, msg_id in admin_msgs.items():
-            try:
-                await bot.edit_message_caption(
-                    chat_id=int(admin_id_str),
-                    message_id=msg_id,
-                    caption=f"✅ Матч №{match_id} подтвержден. Победили {winner_team.upper()}.\n(Подтвердил: {callback.from_user.full_name})"
-                )
-            except: pass
+        caption = f"✅ Матч №{match_id} подтвержден. Победили {winner_team.upper()}.\n(Подтвердил: {callback.from_user.full_name})"
+        calls = {
+            int(admin_id_str): partial(bot.edit_message_caption, chat_id=int(admin_id_str), message_id=msg_id, caption=caption)
+            for admin_id_str, msg_id in admin_msgs.items()
+        }
+        await fanout.broadcast(f"admins:{match_id}", calls, level=outbox.PRIORITY_MATCH)
         await app_state.delete_data(f"admin_msgs:{match_id}")
         
     await app_state.delete_match(match_id, pending=False)
@@ -1384,22 +1497,18 @@ async def admin_cancel_match(callback: types.CallbackQuery):
     import state as app_state
     match = await app_state.get_match(match_id, pending=False)
     if match:
-        for p_uid_str, _ in match['players']:
-            try:
-                await bot.send_message(int(p_uid_str), f"❌ Результат матча №{match_id} был отклонен админом.")
-            except: pass
+        text = f"❌ Результат матча №{match_id} был отклонен админом."
+        await fanout.notify(f"rejected:{match_id}", bot, {int(p_uid_str): text for p_uid_str, _ in match['players']})
             
     # Синхронизация: удаляем кнопки у всех админов
     admin_msgs = await app_state.get_data(f"admin_msgs:{match_id}")
     if admin_msgs:
-        for admin_id_str, msg_id in admin_msgs.items():
-            try:
-                await bot.edit_message_caption(
-                    chat_id=int(admin_id_str),
-                    message_id=msg_id,
-                    caption=f"❌ Результат матча №{match_id} отклонен.\n(Отклонил: {callback.from_user.full_name})"
-                )
-            except: pass
+        caption = f"❌ Результат матча №{match_id} отклонен.\n(Отклонил: {callback.from_user.full_name})"
+        calls = {
+            int(admin_id_str): partial(bot.edit_message_caption, chat_id=int(admin_id_str), message_id=msg_id, caption=caption)
+            for admin_id_str, msg_id in admin_msgs.items()
+        }
+        await fanout.broadcast(f"admins:{match_id}", calls, level=outbox.PRIORITY_MATCH)
         await app_state.delete_data(f"admin_msgs:{match_id}")
     
     await app_state.delete_match(match_id, pending=False)
@@ -1416,73 +1525,38 @@ async def lobby_exit_callback(callback: types.CallbackQuery):
     
     import core
     result = await core.leave_lobby(user_id, mode, lobby_id)
+    if result["status"] != "success":
+        # Если в указанном нет, выходим из текущего лобби по обратному индексу (на случай рассинхрона)
+        result = await core.leave_current_lobby(user_id)
     
     if result["status"] == "success":
         await callback.message.answer("❌ Вы вышли из лобби.")
-        await update_all_lobby_messages(mode, lobby_id)
-        await update_lobby_list_for_all(mode)
     else:
-        # Если в указанном нет, проверяем все лобби (на случай рассинхрона)
-        import state
-        current = await state.get_user_current_lobby(user_id)
-        if current:
-            await core.leave_lobby(user_id, current["mode"], current["id"])
-            await callback.message.answer("❌ Вы вышли из лобби.")
-            await update_all_lobby_messages(current["mode"], current["id"])
-            await update_lobby_list_for_all(current["mode"])
-        else:
-            await callback.answer(result.get("message", "Вы не в лобби."), show_alert=True)
+        await callback.answer(result.get("message", "Вы не в лобби."), show_alert=True)
 
 @dp.message(F.text == "Список лидеров 🏆")
 async def leaderboard(message: types.Message):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == message.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        # Проверка временного бана
-        ban_until_str = user_db_data[6]
-        if ban_until_str:
-            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() < ban_until:
-                await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
-                return
-            else:
-                db.set_ban_status(message.from_user.id, False)
-        else:
-            await message.answer("❌ Вы заблокированы.")
-            return
-
-    top_players = db.get_top_players(10)
+    import state
+    top_players = await state.get_leaderboard_top(10)
     if not top_players:
         await message.answer("Список лидеров пока пуст.", reply_markup=main_menu_keyboard(message.from_user.id))
         return
         
     text = "🏆 1 СЕЗОН: ТОП-10 ИГРОКОВ\n\n"
-    for i, (nickname, elo, level) in enumerate(top_players, 1):
+    for p in top_players:
+        i = p["rank"]
         medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-        text += f"{medal} {nickname} — {elo} ELO (Lvl {level})\n"
+        text += f"{medal} {p['nickname']} — {p['elo']} ELO (Lvl {db.get_level_by_elo(p['elo'])})\n"
+    
+    # Место самого игрока, если он не попал в топ
+    my_rank = await state.get_leaderboard_rank(message.from_user.id)
+    if my_rank and my_rank["rank"] > len(top_players):
+        text += f"\n📍 Ваше место: {my_rank['rank']} — {my_rank['elo']} ELO"
     
     await message.answer(text, reply_markup=main_menu_keyboard(message.from_user.id))
 
 @dp.message(F.text == "Правила 📖")
 async def rules(message: types.Message):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == message.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        # Проверка временного бана
-        ban_until_str = user_db_data[6]
-        if ban_until_str:
-            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() < ban_until:
-                await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
-                return
-            else:
-                db.set_ban_status(message.from_user.id, False)
-        else:
-            await message.answer("❌ Вы заблокированы.")
-            return
-
     rules_text = (
         "📖 БАЗОВЫЕ ПРАВИЛА FACEIT (PROJECT EVOLUTION):\n\n"
         "1. 👤 Никнейм в боте ДОЛЖЕН совпадать с никнеймом в игре. За несовпадение — аннулирование результата.\n"
@@ -1502,23 +1576,6 @@ async def rules(message: types.Message):
 
 @dp.message(F.text == "Поддержка 🛠️")
 async def support_handler(message: types.Message, state: FSMContext):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == message.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        # Проверка временного бана
-        ban_until_str = user_db_data[6]
-        if ban_until_str:
-            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() < ban_until:
-                await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
-                return
-            else:
-                db.set_ban_status(message.from_user.id, False)
-        else:
-            await message.answer("❌ Вы заблокированы в этом боте.")
-            return
-
     # Состояние очищается в мидлвари, но на всякий случай
     await state.clear()
     await state.set_state(SupportState.waiting_for_message)
@@ -1591,13 +1648,6 @@ async def process_support_message(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data.startswith("sup_take_"))
 async def handle_support_take(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == callback.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        await callback.answer("❌ Вы заблокированы.", show_alert=True)
-        return
-
     if callback.from_user.id not in ADMINS: return
     
     ticket_id = int(callback.data.split("_")[2])
@@ -1721,23 +1771,6 @@ async def process_admin_reply(message: types.Message, state: FSMContext):
 
 @dp.message(F.text == "Настройки ⚙️")
 async def settings_handler(message: types.Message, state: FSMContext):
-    # Проверка на бан
-    all_users = db.get_all_users()
-    user_db_data = next((u for u in all_users if u[0] == message.from_user.id), None)
-    if user_db_data and len(user_db_data) > 5 and user_db_data[5] == 1:
-        # Проверка временного бана
-        ban_until_str = user_db_data[6]
-        if ban_until_str:
-            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
-            if datetime.now() < ban_until:
-                await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
-                return
-            else:
-                db.set_ban_status(message.from_user.id, False)
-        else:
-            await message.answer("❌ Вы заблокированы в этом боте.")
-            return
-
     # Состояние очищается в мидлвари, но на всякий случай
     await state.clear()
     
@@ -1787,7 +1820,7 @@ async def process_new_nick(message: types.Message, state: FSMContext):
         await message.answer("Никнейм должен быть текстовым и не длиннее 20 символов.")
         return
     
-    db.update_user_profile(message.from_user.id, nickname=message.text)
+    await async_db.update_user_profile(message.from_user.id, nickname=message.text)
     await message.answer(f"✅ Ваш никнейм успешно изменен на: {message.text}")
     await state.clear()
 
@@ -1820,39 +1853,80 @@ async def process_new_id(message: types.Message, state: FSMContext):
         await message.answer("ID должен состоять только из 8-9 цифр.")
         return
     
-    db.update_user_profile(message.from_user.id, game_id=message.text)
+    await async_db.update_user_profile(message.from_user.id, game_id=message.text)
     await message.answer(f"✅ Ваш игровой ID успешно изменен на: {message.text}")
     await state.clear()
 
+@dp.message(Command("rebuild_leaderboard"))
+async def rebuild_leaderboard_command(message: types.Message):
+    if message.from_user.id not in ADMINS: return
+    count = await async_db.rebuild_leaderboard()
+    await message.answer(f"✅ Лидерборд пересобран из базы: {count} игроков.")
+
+@dp.message(Command("metrics"))
+async def metrics_command(message: types.Message):
+    if message.from_user.id not in ADMINS: return
+    fan = fanout.get_stats()
+    out = outbox.get_stats()
+    ref = refresh.get_stats()
+    sch = scheduler.get_stats()
+    text = (
+        "📊 Метрики\n\n"
+        f"Рассылки: {fan['broadcasts']} (сообщений: {fan['messages']})\n"
+        f"Задержка рассылки: средняя {fan['avg_ms']:.0f} мс, последняя {fan['last_ms']:.0f} мс, макс. {fan['max_ms']:.0f} мс\n"
+        f"Недоставлено: {fan['dead']} удалено, {fan['failed']} отброшено\n\n"
+        f"Очередь отправки: {out['depth']} сейчас, макс. {out['max_depth']}\n"
+        f"Отправлено: {out['sent']}, ошибок: {out['errors']}, повторов после 429: {out['retried']}, отброшено: {out['dropped']}\n"
+        f"Среднее время в очереди и отправке: {out['avg_latency_ms']:.0f} мс\n\n"
+        f"Обновления экранов: {ref['requested']} запрошено, {ref['flushed']} выполнено (x{ref['coalescing_ratio']:.1f})\n"
+        f"Таймеры матчей: {sch['scheduled']} поставлено, {sch['cancelled']} отменено, {sch['fired']} сработало, "
+        f"{sch['failed']} с ошибкой, макс. опоздание {sch['lag_ms_max']:.0f} мс"
+    )
+    upd = ordered.get_stats()
+    busiest = max(upd["shards"], key=lambda s: s["queue"], default=None)
+    text += (
+        f"\nОбновления: {upd['processed']} обработано, в очереди {upd['queued']}"
+        f" (макс. в шарде {busiest['queue'] if busiest else 0}), макс. задержка {upd['lag_ms_max']:.0f} мс"
+    )
+    push = lobby_events.get_stats()
+    text += f"\nMini App: {push['clients']} потоков, {push['events']} событий лобби, {push['snapshots']} снимков"
+    api = http_cache.get_stats()
+    text += (
+        f"\nAPI: {api['requests']} запросов, {api['not_modified']} ответов 304, {api['hits']} из кэша, "
+        f"{api['misses']} собрано (попаданий {api['hit_rate']:.0%})"
+    )
+    if WEBHOOK_URL:
+        wh = webhook.get_stats()
+        text += (
+            f"\nWebhook: {wh['received']} принято, {wh['processed']} обработано, {wh['failed']} с ошибкой, "
+            f"{wh['rejected']} отклонено (503), в работе {wh['pending']}"
+        )
+    await message.answer(text)
+
 @dp.message(F.text == "Админ-панель 👑")
 async def admin_panel_handler(message: types.Message, state: FSMContext):
     # Состояние очищается в мидлвари, но на всякий случай
     await state.clear()
     if message.from_user.id not in ADMINS: return
     
-    users = db.get_all_users()
-    text = f"👑 АДМИН-ПАНЕЛЬ\nВсего игроков: {len(users)}\n\nВыберите действие:"
+    total = await async_db.count_users()
+    text = f"👑 АДМИН-ПАНЕЛЬ\nВсего игроков: {total}\n\nВыберите действие:"
     
     builder = InlineKeyboardBuilder()
-    builder.row(types.InlineKeyboardButton(text="👥 Список игроков", callback_data="admin_users_list_0"))
+    builder.row(types.InlineKeyboardButton(text="👥 Список игроков", callback_data="admin_users_list_0_a0"))
     # Добавляем другие кнопки, если они были нужны
     
     await message.answer(text, reply_markup=builder.as_markup())
 
-@dp.callback_query(F.data.startswith("admin_users_list_"))
-async def admin_users_list_callback(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMINS: return
-    
-    page = int(callback.data.split("_")[-1])
-    users = db.get_all_users()
-    
-    # Пагинация по 10 человек
+async def show_users_page(message: types.Message, page: int, after_id: int = 0, before_id: int = None, edit: bool = True):
+    # Пагинация по 10 человек, keyset по user_id (см. db.get_users_page)
     per_page = 10
-    start = page * per_page
-    end = start + per_page
-    current_users = users[start:end]
+    current_users, has_prev, has_next = await async_db.get_users_page(after_id, before_id, per_page)
+    total = await async_db.count_users()
+    # Курсор текущей страницы: все user_id больше него, нужен для "Обновить" и возврата после бана
+    cursor = current_users[0][0] - 1 if current_users else after_id
     
-    text = f"👥 СПИСОК ИГРОКОВ (Страница {page + 1})\n\n"
+    text = f"👥 СПИСОК ИГРОКОВ (Страница {page + 1}, всего игроков: {total})\n\n"
     builder = InlineKeyboardBuilder()
     
     for u in current_users:
@@ -1868,35 +1942,53 @@ async def admin_users_list_callback(callback: types.CallbackQuery):
         text += f"👤 {nick} (ID: {uid})\n🎮 GameID: {gid} | ELO: {elo} | Lvl: {lvl}\nСтатус: {status}\nПредупреждения: {missed_games}/3\n\n"
         
         if banned:
-            builder.row(types.InlineKeyboardButton(text=f"🔓 Разбанить {nick}", callback_data=f"admin_ban_{uid}_0_{page}"))
+            builder.row(types.InlineKeyboardButton(text=f"🔓 Разбанить {nick}", callback_data=f"admin_ban_{uid}_0_{page}_{cursor}"))
         else:
             builder.row(
-                types.InlineKeyboardButton(text="30м", callback_data=f"admin_ban_{uid}_30m_{page}"),
-                types.InlineKeyboardButton(text="1ч", callback_data=f"admin_ban_{uid}_1h_{page}"),
-                types.InlineKeyboardButton(text="12ч", callback_data=f"admin_ban_{uid}_12h_{page}"),
-                types.InlineKeyboardButton(text="24ч", callback_data=f"admin_ban_{uid}_24h_{page}"),
-                types.InlineKeyboardButton(text="∞", callback_data=f"admin_ban_{uid}_inf_{page}")
+                types.InlineKeyboardButton(text="30м", callback_data=f"admin_ban_{uid}_30m_{page}_{cursor}"),
+                types.InlineKeyboardButton(text="1ч", callback_data=f"admin_ban_{uid}_1h_{page}_{cursor}"),
+                types.InlineKeyboardButton(text="12ч", callback_data=f"admin_ban_{uid}_12h_{page}_{cursor}"),
+                types.InlineKeyboardButton(text="24ч", callback_data=f"admin_ban_{uid}_24h_{page}_{cursor}"),
+                types.InlineKeyboardButton(text="∞", callback_data=f"admin_ban_{uid}_inf_{page}_{cursor}")
             )
         builder.row(types.InlineKeyboardButton(text=f"📊 Изменить ELO {nick}", callback_data=f"admin_elo_{uid}"))
         builder.row(types.InlineKeyboardButton(text=f"📈 Изменить Winrate {nick}", callback_data=f"admin_stats_{uid}"))
         builder.row(types.InlineKeyboardButton(text=f"✉️ Написать {nick}", callback_data=f"admin_msg_{uid}"))
     
-    # Кнопки навигации
+    # Кнопки навигации: "a" - страница после user_id, "b" - страница перед user_id
     nav_btns = []
-    if page > 0:
-        nav_btns.append(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_users_list_{page - 1}"))
-    if end < len(users):
-        nav_btns.append(types.InlineKeyboardButton(text="Вперед ➡️", callback_data=f"admin_users_list_{page + 1}"))
+    if has_prev and current_users:
+        nav_btns.append(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_users_list_{max(page - 1, 0)}_b{current_users[0][0]}"))
+    if has_next and current_users:
+        nav_btns.append(types.InlineKeyboardButton(text="Вперед ➡️", callback_data=f"admin_users_list_{page + 1}_a{current_users[-1][0]}"))
     
     if nav_btns:
         builder.row(*nav_btns)
         
-    builder.row(types.InlineKeyboardButton(text="🔄 Обновить", callback_data=f"admin_users_list_{page}"))
+    builder.row(types.InlineKeyboardButton(text="🔄 Обновить", callback_data=f"admin_users_list_{page}_a{cursor}"))
     
-    try:
-        await callback.message.edit_text(text, reply_markup=builder.as_markup())
-    except TelegramBadRequest:
-        pass
+    if edit:
+        try:
+            await message.edit_text(text, reply_markup=builder.as_markup())
+        except TelegramBadRequest:
+            pass
+    else:
+        await message.answer(text, reply_markup=builder.as_markup())
+
+@dp.callback_query(F.data.startswith("admin_users_list_"))
+async def admin_users_list_callback(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMINS: return
+    
+    parts = callback.data.split("_")
+    page = int(parts[3])
+    after_id, before_id = 0, None
+    if len(parts) > 4:
+        if parts[4].startswith("b"):
+            before_id = int(parts[4][1:])
+        else:
+            after_id = int(parts[4][1:])
+    
+    await show_users_page(callback.message, page, after_id, before_id)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_ban_"))
@@ -1907,13 +1999,14 @@ async def admin_ban_callback(callback: types.CallbackQuery, state: FSMContext):
     target_uid = int(parts[2])
     duration_type = parts[3]
     page = int(parts[4])
+    cursor = int(parts[5]) if len(parts) > 5 else 0
     
     if duration_type == "0":
-        db.set_ban_status(target_uid, False)
+        await bans.set_ban_status(target_uid, False)
         try: await bot.send_message(target_uid, "✅ Администратор разблокировал ваш аккаунт.")
         except: pass
         await callback.answer("Пользователь разблокирован!")
-        await admin_users_list_callback(callback)
+        await show_users_page(callback.message, page, after_id=cursor)
     else:
         # Сохраняем данные для процесса бана
         until = None
@@ -1933,7 +2026,7 @@ async def admin_ban_callback(callback: types.CallbackQuery, state: FSMContext):
         else:
             duration_text = "навсегда"
             
-        await state.update_data(ban_target=target_uid, ban_until=until, ban_duration=duration_text, ban_page=page)
+        await state.update_data(ban_target=target_uid, ban_until=until, ban_duration=duration_text, ban_page=page, ban_cursor=cursor)
         await state.set_state(AdminAction.waiting_for_ban_reason)
         await callback.message.answer(f"Введите причину бана для игрока (ID: {target_uid}) {duration_text}:")
         await callback.answer()
@@ -1948,7 +2041,7 @@ async def process_ban_reason(message: types.Message, state: FSMContext):
     page = data['ban_page']
     reason = message.text
     
-    db.set_ban_status(target_uid, True, until=until)
+    await bans.set_ban_status(target_uid, True, until=until)
     
     try:
         ban_msg = f"🛑 Вы были заблокированы {duration}.\nПричина: {reason}"
@@ -1961,17 +2054,7 @@ async def process_ban_reason(message: types.Message, state: FSMContext):
     await state.clear()
     
     # Возвращаемся к списку
-    users = db.get_all_users()
-    # Эмулируем callback для вызова списка
-    class FakeCallback:
-        def __init__(self, msg, user):
-            self.message = msg
-            self.from_user = user
-        async def answer(self, text=None, show_alert=False): pass
-        @property
-        def data(self): return f"admin_users_list_{page}"
-
-    await admin_users_list_callback(FakeCallback(message, message.from_user))
+    await show_users_page(message, page, after_id=data.get('ban_cursor', 0), edit=False)
 
 @dp.callback_query(F.data.startswith("admin_msg_"))
 async def admin_msg_callback(callback: types.CallbackQuery, state: FSMContext):
@@ -2044,7 +2127,7 @@ async def process_admin_stats_change(callback: types.CallbackQuery):
         wins_change = -1
         msg = "Удалена 1 победа"
         
-    db.adjust_user_stats(target_uid, matches_change, wins_change)
+    await async_db.adjust_user_stats(target_uid, matches_change, wins_change)
     await callback.message.answer(f"✅ Для игрока {target_uid} успешно: {msg}")
     await callback.answer()
 
@@ -2071,10 +2154,10 @@ async def process_admin_elo_change(message: types.Message, state: FSMContext):
     data = await state.get_data()
     target_uid = data['elo_target']
     
-    db.manual_update_elo(target_uid, elo_change)
+    await async_db.manual_update_elo(target_uid, elo_change)
     
     # Получаем обновленные данные
-    user_data = db.get_user(target_uid)
+    user_data = await async_db.get_user(target_uid)
     new_elo = user_data[2]
     new_lvl = user_data[3]
     
@@ -2088,6 +2171,13 @@ async def process_admin_elo_change(message: types.Message, state: FSMContext):
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if WEBHOOK_URL:
+            # Несколько воркеров требуют строку импорта: каждый процесс загрузит main заново
+            uvicorn.run(
+                "main:app" if WEB_CONCURRENCY > 1 else fastapi_app,
+                host="0.0.0.0", port=PORT, workers=WEB_CONCURRENCY, timeout_graceful_shutdown=SHUTDOWN_GRACE
+            )
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logging.info("Bot stopped!")
@@ -0,0 +1,132 @@
+"""Упорядоченная по пользователю и параллельная между пользователями обработка.
+
+OrderedUpdatesMiddleware (outer-мидлварь на dp.update, до чтения FSM)
+отправляет каждое обновление в один из UPDATE_SHARDS шардов по id
+пользователя (или чата).
+Шард обрабатывает свои обновления строго по очереди, поэтому переходы FSM
+и двойные нажатия одного игрока не перемешиваются, а разные шарды
+работают параллельно, и медленный обработчик задерживает только игроков
+своего шарда. Для каждого шарда считаются длина очереди и задержка до
+начала обработки.
+
+Порядок гарантируется только внутри одного процесса. В webhook-режиме с
+WEB_CONCURRENCY > 1 обновления одного игрока могут прийти в разные
+воркеры; там их сериализует не шард, а блокировка FSM в Redis
+(events_isolation диспетчера в main.py): обработчики одного игрока не
+выполняются одновременно, но порядок между воркерами не гарантирован.
+"""
+import asyncio
+import os
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.middleware import FSMContextMiddleware
+
+UPDATE_SHARDS = int(os.getenv("UPDATE_SHARDS", 16))
+
+class _Shard:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.worker = None
+        self.busy = False
+        self.processed = 0
+        self.lag_ms_last = 0.0
+        self.lag_ms_max = 0.0
+
+_shards = []
+
+def _get_shard(key):
+    if not _shards:
+        _shards.extend(_Shard() for _ in range(UPDATE_SHARDS))
+    shard = _shards[hash(key) % len(_shards)]
+    if shard.worker is None or shard.worker.done():
+        shard.worker = asyncio.create_task(_run_shard(shard))
+    return shard
+
+async def _run_shard(shard):
+    while True:
+        enqueued_at, call, future = await shard.queue.get()
+        if future.done():
+            continue
+        lag_ms = (time.monotonic() - enqueued_at) * 1000
+        shard.lag_ms_last = lag_ms
+        shard.lag_ms_max = max(shard.lag_ms_max, lag_ms)
+        shard.busy = True
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            shard.busy = False
+            shard.processed += 1
+
+async def submit(key, call):
+    """Выполняет call в шарде ключа key после всех ранее поставленных туда вызовов."""
+    shard = _get_shard(key)
+    future = asyncio.get_running_loop().create_future()
+    shard.queue.put_nowait((time.monotonic(), call, future))
+    return await future
+
+class OrderedUpdatesMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        key = user.id if user else (chat.id if chat else None)
+        if key is None:
+            return await handler(event, data)
+        return await submit(key, lambda: handler(event, data))
+
+def setup(*dispatchers):
+    for dispatcher in dispatchers:
+        if dispatcher is None:
+            continue
+        # Встаем перед FSMContextMiddleware: состояние FSM должно читаться уже в шарде,
+        # иначе вторая из очереди получит состояние, прочитанное до обработки первой.
+        # Публичного API для вставки в начало цепочки нет, поэтому правим список напрямую.
+        # Это внутренности aiogram (проверено на 3.31): если они изменятся, падаем при
+        # старте, а не тихо теряем порядок
+        middlewares = getattr(dispatcher.update.outer_middleware, "_middlewares", None)
+        if not isinstance(middlewares, list):
+            raise RuntimeError("aiogram internals changed: outer_middleware._middlewares is not a list")
+        position = next(
+            (i for i, m in enumerate(middlewares) if isinstance(m, FSMContextMiddleware)),
+            None
+        )
+        if position is None:
+            raise RuntimeError("aiogram internals changed: FSMContextMiddleware not found in update outer middlewares")
+        middlewares.insert(position, OrderedUpdatesMiddleware())
+
+async def stop():
+    tasks = [shard.worker for shard in _shards if shard.worker]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for shard in _shards:
+        while not shard.queue.empty():
+            _, _, future = shard.queue.get_nowait()
+            future.cancel()
+    _shards.clear()
+
+def get_stats():
+    shards = [
+        {
+            "queue": shard.queue.qsize() + (1 if shard.busy else 0),
+            "processed": shard.processed,
+            "lag_ms_last": shard.lag_ms_last,
+            "lag_ms_max": shard.lag_ms_max,
+        }
+        for shard in _shards
+    ]
+    return {
+        "shards": shards,
+        "queued": sum(s["queue"] for s in shards),
+        "processed": sum(s["processed"] for s in shards),
+        "lag_ms_max": max((s["lag_ms_max"] for s in shards), default=0.0),
+    }
@@ -0,0 +1,272 @@
+"""Единая очередь исходящих сообщений Telegram.
+
+Все отправки и правки сообщений обоих ботов проходят через request-мидлварь
+OutboxMiddleware и попадают в общую приоритетную очередь. Воркеры берут из
+нее задания с учетом двух token bucket: общего на бота (OUTBOX_GLOBAL_RATE
+сообщений в секунду) и отдельного на каждый чат (OUTBOX_CHAT_RATE). Ответ
+429 не теряет сообщение: чат ставится на паузу на retry_after, а задание
+возвращается в очередь (не больше OUTBOX_RETRIES раз).
+
+Приоритет задается контекстом вызова: `with outbox.priority(...)` или
+декоратором `@outbox.prioritized(...)`. Задачи, созданные внутри, наследуют
+приоритет. Если очередь переполнена, косметические обновления
+(PRIORITY_LOBBY) отбрасываются с OutboxDropped, остальные принимаются всегда.
+
+Ведра живут в памяти процесса. Если процессов несколько (воркеры uvicorn в
+режиме webhook), setup получает их число, и каждый процесс берет свою долю
+OUTBOX_GLOBAL_RATE, чтобы суммарная скорость не превышала лимит Telegram.
+Лимит на чат при этом соблюдается только внутри процесса: редкий 429 из-за
+сообщений в один чат из разных процессов обрабатывается повтором.
+"""
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage, DeleteMessage, EditMessageCaption, EditMessageReplyMarkup,
+    EditMessageText, ForwardMessage, SendDocument, SendMediaGroup, SendMessage, SendPhoto
+)
+
+PRIORITY_MATCH = 0   # найден матч, подтверждение, баны и пики
+PRIORITY_NORMAL = 1  # ответы на действия пользователя
+PRIORITY_LOBBY = 2   # косметические обновления лобби и списков
+
+GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 25))
+CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))
+CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", 3))
+MAX_QUEUE = int(os.getenv("OUTBOX_MAX_QUEUE", 1000))
+MAX_RETRIES = int(os.getenv("OUTBOX_RETRIES", 3))
+WORKERS = int(os.getenv("OUTBOX_WORKERS", 8))
+
+# Методы, которые идут через очередь. Остальные (answer_callback_query,
+# get_chat_member и т.п.) выполняются сразу
+QUEUED_METHODS = (
+    SendMessage, SendPhoto, SendDocument, SendMediaGroup, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup, DeleteMessage
+)
+
+class OutboxDropped(Exception):
+    """Сообщение не отправлено: очередь переполнена или исчерпаны повторы."""
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        # Сколько ждать до следующего разрешенного запроса
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class _Job:
+    __slots__ = ("call", "bot_id", "chat_id", "priority", "seq", "future", "attempts")
+
+    def __init__(self, call, bot_id, chat_id, priority, seq, future):
+        self.call = call
+        self.bot_id = bot_id
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+_priority = contextvars.ContextVar("outbox_priority", default=PRIORITY_NORMAL)
+_seq = itertools.count()
+_queue = None
+_workers = []
+_deferred = 0
+# Лимиты Telegram действуют на каждого бота отдельно
+_global_buckets = {}
+# Сколько процессов делят OUTBOX_GLOBAL_RATE (см. setup)
+_processes = 1
+_chat_buckets = {}
+
+stats = {
+    "enqueued": 0,
+    "sent": 0,
+    "errors": 0,
+    "retried": 0,
+    "dropped": 0,
+    "max_depth": 0,
+    "latency_ms_total": 0.0,
+}
+
+@contextmanager
+def priority(level):
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def prioritized(level):
+    # Декоратор: все сообщения внутри функции (и запущенных ею задач) идут с этим приоритетом
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with priority(level):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def depth():
+    return (_queue.qsize() if _queue else 0) + _deferred
+
+def _global_bucket(bot_id):
+    bucket = _global_buckets.get(bot_id)
+    if bucket is None:
+        rate = GLOBAL_RATE / _processes
+        bucket = _global_buckets[bot_id] = TokenBucket(rate, max(1.0, rate))
+    return bucket
+
+def _chat_bucket(bot_id, chat_id):
+    key = (bot_id, chat_id)
+    bucket = _chat_buckets.get(key)
+    if bucket is None:
+        if len(_chat_buckets) > 10000:
+            # Полные ведра ничего не ограничивают - их можно забыть
+            now = time.monotonic()
+            for key in [k for k, b in _chat_buckets.items() if b.delay(now) == 0 and b.tokens >= b.capacity]:
+                del _chat_buckets[key]
+        bucket = _chat_buckets[key] = TokenBucket(CHAT_RATE, CHAT_BURST)
+    return bucket
+
+def _requeue(job):
+    global _deferred
+    _deferred -= 1
+    if _queue is None:
+        if not job.future.done():
+            job.future.set_exception(OutboxDropped("Outbox stopped"))
+        return
+    _queue.put_nowait(job)
+
+def _defer(job, wait):
+    global _deferred
+    _deferred += 1
+    asyncio.get_running_loop().call_later(wait, _requeue, job)
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        if job.future.done():
+            continue
+        bucket = _chat_bucket(job.bot_id, job.chat_id)
+        wait = bucket.delay(time.monotonic())
+        if wait > 0:
+            # Чат упирается в свой лимит - не занимаем воркер, возвращаемся позже
+            _defer(job, wait)
+            continue
+        global_bucket = _global_bucket(job.bot_id)
+        while (wait := global_bucket.delay(time.monotonic())) > 0:
+            await asyncio.sleep(wait)
+        global_bucket.take()
+        bucket.take()
+
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            bucket.block(e.retry_after)
+            job.attempts += 1
+            if job.attempts > MAX_RETRIES:
+                stats["dropped"] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                stats["retried"] += 1
+                logging.warning(f"Telegram flood control for chat {job.chat_id}: retry in {e.retry_after}s")
+                _defer(job, e.retry_after)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            stats["errors"] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            stats["sent"] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+async def submit(call, chat_id, bot_id=None, level=None):
+    """Ставит вызов Bot API в очередь и ждет его результата."""
+    level = _priority.get() if level is None else level
+    current = depth()
+    if current >= MAX_QUEUE and level >= PRIORITY_LOBBY:
+        stats["dropped"] += 1
+        raise OutboxDropped(f"Outbox is full ({current} jobs)")
+
+    future = asyncio.get_running_loop().create_future()
+    _queue.put_nowait(_Job(call, bot_id, chat_id, level, next(_seq), future))
+    stats["enqueued"] += 1
+    stats["max_depth"] = max(stats["max_depth"], current + 1)
+    started = time.monotonic()
+    try:
+        return await future
+    finally:
+        stats["latency_ms_total"] += (time.monotonic() - started) * 1000
+
+class OutboxMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        if _queue is None or not isinstance(method, QUEUED_METHODS):
+            return await make_request(bot, method)
+        return await submit(lambda: make_request(bot, method), getattr(method, "chat_id", None), bot.id)
+
+def setup(*bots, processes=1):
+    """Подключает очередь к ботам; processes - сколько процессов отправляют от имени тех же ботов."""
+    global _processes
+    _processes = max(1, processes)
+    for bot in bots:
+        if bot is not None:
+            bot.session.middleware(OutboxMiddleware())
+
+def start():
+    # Вызывается внутри запущенного event loop. До старта мидлварь пропускает запросы напрямую
+    global _queue
+    if _queue is None:
+        _queue = asyncio.PriorityQueue()
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(WORKERS))
+
+async def stop():
+    global _queue
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    queue, _queue = _queue, None
+    while queue is not None and not queue.empty():
+        job = queue.get_nowait()
+        if not job.future.done():
+            job.future.set_exception(OutboxDropped("Outbox stopped"))
+
+def get_stats():
+    result = dict(stats)
+    result["depth"] = depth()
+    finished = stats["sent"] + stats["errors"]
+    result["avg_latency_ms"] = stats["latency_ms_total"] / finished if finished else 0.0
+    return result
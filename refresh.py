@@ -0,0 +1,49 @@
+"""Отложенные и объединенные обновления экранов лобби.
+
+Вместо немедленной перерисовки экран помечается "грязным" через
+`schedule(key, flush)`. Первая отметка запускает задачу, которая через
+LOBBY_REFRESH_WINDOW секунд вызывает flush один раз; все отметки за это
+окно объединяются в эту же перерисовку. Если за время перерисовки экран
+снова помечен, она повторяется после следующего окна - последнее
+состояние не теряется, а одновременно для одного ключа идет не больше
+одной перерисовки.
+"""
+import asyncio
+import logging
+import os
+
+LOBBY_REFRESH_WINDOW = float(os.getenv("LOBBY_REFRESH_WINDOW", 0.3))
+
+_dirty = set()
+_tasks = {}
+
+stats = {
+    "requested": 0,
+    "flushed": 0,
+}
+
+async def _run(key, flush):
+    try:
+        while key in _dirty:
+            await asyncio.sleep(LOBBY_REFRESH_WINDOW)
+            _dirty.discard(key)
+            stats["flushed"] += 1
+            try:
+                await flush()
+            except Exception as e:
+                logging.error(f"Failed to refresh {key}: {e}")
+    finally:
+        _tasks.pop(key, None)
+
+def schedule(key, flush):
+    """Помечает экран key для перерисовки; flush - корутинная функция без аргументов."""
+    stats["requested"] += 1
+    _dirty.add(key)
+    if key not in _tasks:
+        _tasks[key] = asyncio.create_task(_run(key, flush))
+
+def get_stats():
+    result = dict(stats)
+    result["pending"] = len(_dirty)
+    result["coalescing_ratio"] = stats["requested"] / stats["flushed"] if stats["flushed"] else 0.0
+    return result
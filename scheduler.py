@@ -0,0 +1,84 @@
+"""Отложенные события матчей на Redis вместо спящих asyncio-задач.
+
+Событие - это вид (kind), ключ и аргументы обработчика. Оно хранится в
+ZSET deadlines (см. state.py) под id "{kind}:{key}", поэтому повторная
+постановка того же события (новый ход бана) просто переносит срок, а
+cancel снимает его, когда ход сделан. Один цикл run() раз в
+SCHEDULER_POLL_INTERVAL забирает наступившие события и вызывает
+обработчики, зарегистрированные через register. События переживают
+перезапуск: просроченные за время простоя сработают при старте.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import state
+
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", 0.5))
+SCHEDULER_BATCH = int(os.getenv("SCHEDULER_BATCH", 100))
+
+_handlers = {}
+_running = set()
+
+stats = {
+    "scheduled": 0,
+    "cancelled": 0,
+    "fired": 0,
+    "failed": 0,
+    "lag_ms_max": 0.0,
+}
+
+def register(kind, handler):
+    _handlers[kind] = handler
+
+def _event_id(kind, key):
+    return f"{kind}:{key}"
+
+async def schedule(kind, key, delay, *args):
+    now = time.time()
+    await state.set_deadline(_event_id(kind, key), now + delay, {"kind": kind, "args": list(args), "due": now + delay})
+    stats["scheduled"] += 1
+
+async def cancel(kind, key):
+    if await state.cancel_deadline(_event_id(kind, key)):
+        stats["cancelled"] += 1
+
+async def _fire(event_id, event):
+    handler = _handlers.get(event.get("kind"))
+    if handler is None:
+        logging.error(f"No handler for scheduled event {event_id}")
+        return
+    try:
+        await handler(*event.get("args", []))
+    except Exception as e:
+        stats["failed"] += 1
+        logging.error(f"Scheduled event {event_id} failed: {e}")
+
+def _spawn(event_id, event):
+    task = asyncio.create_task(_fire(event_id, event))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+
+async def run():
+    while True:
+        try:
+            now = time.time()
+            due = await state.claim_due_deadlines(now, SCHEDULER_BATCH)
+            for event_id, event in due:
+                stats["fired"] += 1
+                stats["lag_ms_max"] = max(stats["lag_ms_max"], (now - event.get("due", now)) * 1000)
+                _spawn(event_id, event)
+            if len(due) == SCHEDULER_BATCH:
+                # Очередь не разобрана - забираем следующую пачку сразу
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Scheduler poll failed: {e}")
+        await asyncio.sleep(SCHEDULER_POLL_INTERVAL)
+
+def get_stats():
+    result = dict(stats)
+    result["running"] = len(_running)
+    return result
@@ -1,65 +1,335 @@
 import os
 import json
+import time
 import redis.asyncio as redis
 from typing import Any
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Нужен один узел Redis (можно с репликами и Sentinel), но не Redis Cluster.
+# Lua-скрипты ниже меняют сразу несколько ключей из разных слотов и часть ключей
+# берут из данных, а не из KEYS: прежнее лобби игрока - из обратного индекса
+# (JOIN_LOBBY_SCRIPT), прежнюю аудиторию зрителя - из viewer:{uid}
+# (SET_VIEWER_SCRIPT, REMOVE_VIEWER_SCRIPT), данные зрителей аудитории - по
+# префиксу ключа (GET_AUDIENCE_SCRIPT). В кластере такие скрипты упадут с CROSSSLOT
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 r = redis.from_url(REDIS_URL, decode_responses=True)
 
+MODES = ["1x1", "2x2", "5x5"]
+LOBBY_IDS = range(1, 11)
+MAX_PLAYERS = {"1x1": 2, "2x2": 4, "5x5": 10}
+
+# Лобби хранится как хэш lobby:{mode}:{id}, поле = user_id, значение = JSON данных игрока.
+# Добавление/удаление игрока - одна команда HSET/HDEL без чтения всего лобби
+def lobby_key(mode, lobby_id):
+    return f"lobby:{mode}:{lobby_id}"
+
+def parse_lobby_key(key):
+    _, mode, lobby_id = key.split(":")
+    return mode, int(lobby_id)
+
+ALL_LOBBY_KEYS = [lobby_key(mode, lid) for mode in MODES for lid in LOBBY_IDS]
+
+# Обратный индекс: хэш user_id -> ключ лобби, в котором сейчас игрок.
+# Меняется только вместе с составом лобби (в тех же скриптах/транзакциях)
+LOBBY_INDEX_KEY = "lobby_index"
+
+# Версионирование лобби: счетчик lobby_version растет при каждом изменении состава,
+# а ZSET lobby_changes хранит для каждого лобби версию его последнего изменения.
+# Клиент, знающий версию, получает только лобби, изменившиеся после нее.
+# Заодно изменение публикуется в канал LOBBY_EVENTS_CHANNEL (push в Mini App, см. lobby_events).
+# Все это делается внутри тех же скриптов, что меняют состав: версия не может отстать от данных
+LOBBY_VERSION_KEY = "lobby_version"
+LOBBY_CHANGES_KEY = "lobby_changes"
+LOBBY_EVENTS_CHANNEL = "lobby_events"
+
+# Общая часть скриптов состава. Ключи версии и изменений передаются в KEYS после ключей лобби
+RECORD_LOBBY_CHANGES_LUA = """
+local function record_changes(version_key, changes_key, channel, changed)
+    local version = redis.call('INCR', version_key)
+    for _, key in ipairs(changed) do
+        redis.call('ZADD', changes_key, version, key)
+    end
+    redis.call('PUBLISH', channel, cjson.encode({version = version, lobbies = changed}))
+    return version
+end
+"""
+
+# Атомарный вход в лобби: проверка вместимости, выход из прежнего лобби и добавление.
+# KEYS: целевое лобби, обратный индекс, версия, изменения. ARGV: uid, данные,
+# вместимость (0 - без проверки), канал. Ключ прежнего лобби читается из индекса
+# внутри скрипта (только один узел Redis, см. REDIS_URL).
+# Ответ: {статус, игроков в целевом лобби, [ключ лобби, из которого игрок вышел]}
+JOIN_LOBBY_SCRIPT = RECORD_LOBBY_CHANGES_LUA + """
+local target, index, uid = KEYS[1], KEYS[2], ARGV[1]
+if redis.call('HEXISTS', target, uid) == 1 then
+    return {'already', redis.call('HLEN', target)}
+end
+local count = redis.call('HLEN', target)
+local max_players = tonumber(ARGV[3])
+if max_players > 0 and count >= max_players then
+    return {'full', count}
+end
+local result = {'joined', count + 1}
+local changed = {target}
+local prev = redis.call('HGET', index, uid)
+if prev and prev ~= target and redis.call('HDEL', prev, uid) == 1 then
+    table.insert(result, prev)
+    table.insert(changed, prev)
+end
+redis.call('HSET', target, uid, ARGV[2])
+redis.call('HSET', index, uid, target)
+record_changes(KEYS[3], KEYS[4], ARGV[4], changed)
+return result
+"""
+
+# Выход из лобби. KEYS: лобби, обратный индекс, версия, изменения. ARGV: uid, канал.
+# Ответ: 1, если игрок был в лобби
+LEAVE_LOBBY_SCRIPT = RECORD_LOBBY_CHANGES_LUA + """
+local removed = redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('HGET', KEYS[2], ARGV[1]) == KEYS[1] then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+if removed > 0 then
+    record_changes(KEYS[3], KEYS[4], ARGV[2], {KEYS[1]})
+end
+return removed
+"""
+
+# Забрать весь состав и удалить лобби (старт матча). KEYS как у выхода, ARGV: канал.
+# Ответ: плоский HGETALL
+TAKE_LOBBY_SCRIPT = RECORD_LOBBY_CHANGES_LUA + """
+local data = redis.call('HGETALL', KEYS[1])
+for i = 1, #data, 2 do
+    if redis.call('HGET', KEYS[2], data[i]) == KEYS[1] then
+        redis.call('HDEL', KEYS[2], data[i])
+    end
+end
+redis.call('DEL', KEYS[1])
+if #data > 0 then
+    record_changes(KEYS[3], KEYS[4], ARGV[1], {KEYS[1]})
+end
+return data
+"""
+
+# Полная замена состава. KEYS как у выхода, ARGV: канал, затем пары uid, данные
+SET_LOBBY_SCRIPT = RECORD_LOBBY_CHANGES_LUA + """
+redis.call('DEL', KEYS[1])
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('HSET', KEYS[2], ARGV[i], KEYS[1])
+end
+record_changes(KEYS[3], KEYS[4], ARGV[1], {KEYS[1]})
+return 1
+"""
+
+# Очистка всех лобби. KEYS: обратный индекс, версия, изменения, затем ключи лобби. ARGV: канал
+CLEAR_LOBBIES_SCRIPT = RECORD_LOBBY_CHANGES_LUA + """
+local lobbies = {}
+for i = 4, #KEYS do
+    redis.call('DEL', KEYS[i])
+    table.insert(lobbies, KEYS[i])
+end
+redis.call('DEL', KEYS[1])
+record_changes(KEYS[2], KEYS[3], ARGV[1], lobbies)
+return 1
+"""
+
+_join_lobby_script = r.register_script(JOIN_LOBBY_SCRIPT)
+_leave_lobby_script = r.register_script(LEAVE_LOBBY_SCRIPT)
+_take_lobby_script = r.register_script(TAKE_LOBBY_SCRIPT)
+_set_lobby_script = r.register_script(SET_LOBBY_SCRIPT)
+_clear_lobbies_script = r.register_script(CLEAR_LOBBIES_SCRIPT)
+
+def _membership_keys(mode, lobby_id):
+    return [lobby_key(mode, lobby_id), LOBBY_INDEX_KEY, LOBBY_VERSION_KEY, LOBBY_CHANGES_KEY]
+
+# KEYS: счетчик версии, ZSET изменений. ARGV[1] - версия клиента.
+# Ответ: {текущая версия, [ключ лобби, игроков, ...]} - атомарно, без гонки версии и данных
+LOBBY_CHANGES_SINCE_SCRIPT = """
+local version = tonumber(redis.call('GET', KEYS[1]) or '0')
+local result = {version}
+if tonumber(ARGV[1]) >= version then
+    return result
+end
+for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '(' .. ARGV[1], '+inf')) do
+    table.insert(result, key)
+    table.insert(result, redis.call('HLEN', key))
+end
+return result
+"""
+
+_lobby_changes_since_script = r.register_script(LOBBY_CHANGES_SINCE_SCRIPT)
+
+async def get_lobby_version():
+    return int(await r.get(LOBBY_VERSION_KEY) or 0)
+
+async def get_lobby_changes(since):
+    # (текущая версия, [{"mode", "id", "players", "max"}] изменившихся после since).
+    # None вместо списка, если since из "будущего" (Redis очищен) - нужен полный снимок
+    data = await _lobby_changes_since_script(keys=[LOBBY_VERSION_KEY, LOBBY_CHANGES_KEY], args=[since])
+    version = int(data[0])
+    if since > version:
+        return version, None
+    changes = []
+    for i in range(1, len(data), 2):
+        mode, lobby_id = parse_lobby_key(data[i])
+        changes.append({"id": lobby_id, "mode": mode, "players": int(data[i + 1]), "max": MAX_PLAYERS[mode]})
+    return version, changes
+
 async def get_lobby_players(mode, lobby_id):
-    key = f"lobby:{mode}:{lobby_id}"
-    data = await r.get(key)
-    return json.loads(data) if data else {}
+    data = await r.hgetall(lobby_key(mode, lobby_id))
+    return {uid: json.loads(p_data) for uid, p_data in data.items()}
+
+async def get_lobby_count(mode, lobby_id):
+    return await r.hlen(lobby_key(mode, lobby_id))
 
 async def set_lobby_players(mode, lobby_id, players):
-    key = f"lobby:{mode}:{lobby_id}"
-    await r.set(key, json.dumps(players))
+    # Полная замена состава - для восстановления из БД после clear_lobbies
+    args = [LOBBY_EVENTS_CHANNEL]
+    for uid, p_data in players.items():
+        args.extend([str(uid), json.dumps(p_data)])
+    await _set_lobby_script(keys=_membership_keys(mode, lobby_id), args=args)
+
+async def _run_join(mode, lobby_id, user_id, player_data, max_players):
+    result = await _join_lobby_script(
+        keys=_membership_keys(mode, lobby_id),
+        args=[str(user_id), json.dumps(player_data), max_players, LOBBY_EVENTS_CHANNEL]
+    )
+    return {
+        "status": result[0],
+        "count": int(result[1]),
+        "left": [parse_lobby_key(key) for key in result[2:]]
+    }
 
 async def add_player_to_lobby(mode, lobby_id, user_id, player_data):
-    players = await get_lobby_players(mode, lobby_id)
-    players[str(user_id)] = player_data
-    await set_lobby_players(mode, lobby_id, players)
+    # Без проверки вместимости - для возврата игроков в лобби. Вход игрока - join_lobby
+    return await _run_join(mode, lobby_id, user_id, player_data, 0)
+
+async def join_lobby(mode, lobby_id, user_id, player_data):
+    return await _run_join(mode, lobby_id, user_id, player_data, MAX_PLAYERS[mode])
 
 async def remove_player_from_lobby(mode, lobby_id, user_id):
-    players = await get_lobby_players(mode, lobby_id)
-    if str(user_id) in players:
-        del players[str(user_id)]
-        await set_lobby_players(mode, lobby_id, players)
+    removed = await _leave_lobby_script(keys=_membership_keys(mode, lobby_id), args=[str(user_id), LOBBY_EVENTS_CHANNEL])
+    return removed > 0
+
+async def take_lobby_players(mode, lobby_id):
+    # Читает состав и удаляет лобби атомарно - при старте матча
+    data = await _take_lobby_script(keys=_membership_keys(mode, lobby_id), args=[LOBBY_EVENTS_CHANNEL])
+    return {data[i]: json.loads(data[i + 1]) for i in range(0, len(data), 2)}
+
+async def clear_lobbies():
+    # Удаляет все лобби (в том числе старый формат JSON-строкой) и индекс перед восстановлением из БД
+    await _clear_lobbies_script(
+        keys=[LOBBY_INDEX_KEY, LOBBY_VERSION_KEY, LOBBY_CHANGES_KEY, *ALL_LOBBY_KEYS],
+        args=[LOBBY_EVENTS_CHANNEL]
+    )
 
 async def get_user_current_lobby(user_id):
-    for mode in ["1x1", "2x2", "5x5"]:
-        for lid in range(1, 11):
-            players = await get_lobby_players(mode, lid)
-            if str(user_id) in players:
-                return {"mode": mode, "id": lid}
-    return None
+    key = await r.hget(LOBBY_INDEX_KEY, str(user_id))
+    if not key:
+        return None
+    mode, lobby_id = parse_lobby_key(key)
+    return {"mode": mode, "id": lobby_id}
 
-async def get_all_lobbies_data():
-    result = {}
-    for mode in ["1x1", "2x2", "5x5"]:
-        result[mode] = []
-        for lid in range(1, 11):
-            players = await get_lobby_players(mode, lid)
-            result[mode].append({
-                "id": lid,
-                "players": len(players),
-                "max": 2 if mode == "1x1" else (4 if mode == "2x2" else 10)
-            })
+async def get_lobbies_snapshot(modes=None, with_players=False):
+    # Все лобби выбранных режимов за один pipelined round trip:
+    # HLEN для счетчиков или HGETALL, если нужен и состав (ключ "roster")
+    modes = modes or MODES
+    lobbies = [(mode, lid) for mode in modes for lid in LOBBY_IDS]
+    async with r.pipeline(transaction=False) as pipe:
+        for mode, lid in lobbies:
+            if with_players:
+                pipe.hgetall(lobby_key(mode, lid))
+            else:
+                pipe.hlen(lobby_key(mode, lid))
+        replies = await pipe.execute()
+
+    result = {mode: [] for mode in modes}
+    for (mode, lid), reply in zip(lobbies, replies):
+        entry = {"id": lid, "players": reply, "max": MAX_PLAYERS[mode]}
+        if with_players:
+            entry["roster"] = {uid: json.loads(p_data) for uid, p_data in reply.items()}
+            entry["players"] = len(reply)
+        result[mode].append(entry)
     return result
 
-# Функции для управления зрителями (те, кто смотрит список лобби или конкретное лобби)
+async def get_all_lobbies_data():
+    return await get_lobbies_snapshot()
+
+# Функции для управления зрителями (те, кто смотрит список лобби или конкретное лобби).
+# Данные зрителя - viewer:{user_id}, а аудитория каждого экрана - ZSET viewers:{mode}:{lobby_id}
+# (lobby_id = "list" для списка лобби режима, viewers:modes - экран выбора режима)
+# с временем последнего показа в качестве score. Рассылка читает только нужную аудиторию
+VIEWER_TTL = 3600 # Храним 1 час
+
+def viewer_audience_key(mode, lobby_id):
+    if mode is None:
+        return "viewers:modes"
+    return f"viewers:{mode}:{'list' if lobby_id is None else lobby_id}"
+
+# KEYS[1] - viewer:{uid}, KEYS[2] - новая аудитория. ARGV: uid, данные, TTL, текущее время.
+# Прежняя аудитория берется из данных зрителя (только один узел Redis, см. REDIS_URL)
+SET_VIEWER_SCRIPT = """
+local old = redis.call('GET', KEYS[1])
+if old then
+    local ok, prev = pcall(cjson.decode, old)
+    if ok and type(prev) == 'table' and prev['audience'] and prev['audience'] ~= KEYS[2] then
+        redis.call('ZREM', prev['audience'], ARGV[1])
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS[1] - viewer:{uid}. ARGV[1] - uid
+REMOVE_VIEWER_SCRIPT = """
+local old = redis.call('GET', KEYS[1])
+if old then
+    local ok, prev = pcall(cjson.decode, old)
+    if ok and type(prev) == 'table' and prev['audience'] then
+        redis.call('ZREM', prev['audience'], ARGV[1])
+    end
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+# KEYS[1] - аудитория. ARGV: минимальный score (старше - устарели), префикс ключа зрителя:
+# ключи viewer:{uid} строятся в скрипте (только один узел Redis, см. REDIS_URL).
+# Ответ: плоский список {uid, данные, ...}
+GET_AUDIENCE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+local result = {}
+for _, uid in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    local data = redis.call('GET', ARGV[2] .. uid)
+    if data then
+        table.insert(result, uid)
+        table.insert(result, data)
+    else
+        redis.call('ZREM', KEYS[1], uid)
+    end
+end
+return result
+"""
+
+_set_viewer_script = r.register_script(SET_VIEWER_SCRIPT)
+_remove_viewer_script = r.register_script(REMOVE_VIEWER_SCRIPT)
+_get_audience_script = r.register_script(GET_AUDIENCE_SCRIPT)
+
 async def set_viewer(user_id, mode, lobby_id, message_id, chat_id):
     key = f"viewer:{user_id}"
+    audience = viewer_audience_key(mode, lobby_id)
     data = {
         "mode": mode,
         "lobby_id": lobby_id,
         "message_id": message_id,
-        "chat_id": chat_id
+        "chat_id": chat_id,
+        "audience": audience
     }
-    await r.set(key, json.dumps(data), ex=3600) # Храним 1 час
+    await _set_viewer_script(keys=[key, audience], args=[str(user_id), json.dumps(data), VIEWER_TTL, time.time()])
 
 async def get_viewer(user_id):
     key = f"viewer:{user_id}"
@@ -67,24 +337,66 @@ async def get_viewer(user_id):
     return json.loads(data) if data else None
 
 async def remove_viewer(user_id):
-    key = f"viewer:{user_id}"
-    await r.delete(key)
+    await _remove_viewer_script(keys=[f"viewer:{user_id}"], args=[str(user_id)])
 
-async def get_all_viewers():
-    keys = await r.keys("viewer:*")
+async def get_lobby_viewers(mode, lobby_id):
+    # Зрители одного экрана ({user_id: данные}) за один вызов, без KEYS viewer:*
+    data = await _get_audience_script(
+        keys=[viewer_audience_key(mode, lobby_id)],
+        args=[time.time() - VIEWER_TTL, "viewer:"]
+    )
     viewers = {}
-    for key in keys:
+    for i in range(0, len(data), 2):
         try:
-            parts = key.split(":")
-            if len(parts) < 2: continue
-            user_id = parts[1]
-            data = await r.get(key)
-            if data:
-                viewers[int(user_id)] = json.loads(data)
+            viewers[int(data[i])] = json.loads(data[i + 1])
         except (ValueError, json.JSONDecodeError):
             continue
     return viewers
 
+# Кэш проверки подписки на каналы: sub:{user_id} -> "1"/"0" с TTL.
+# Общий для обоих ботов и всех реплик
+def subscription_key(user_id):
+    return f"sub:{user_id}"
+
+async def get_cached_subscription(user_id):
+    value = await r.get(subscription_key(user_id))
+    return None if value is None else value == "1"
+
+async def set_cached_subscription(user_id, subscribed, ttl):
+    await r.set(subscription_key(user_id), "1" if subscribed else "0", ex=max(1, int(ttl)))
+
+async def invalidate_subscription(user_id):
+    await r.delete(subscription_key(user_id))
+
+# Удаляет блокировку, только если она все еще наша (не истекла и не взята другим)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_lock_script = r.register_script(RELEASE_LOCK_SCRIPT)
+
+async def acquire_lock(name, ttl):
+    # Блокировка на ttl секунд: токен только у первого, кто ее взял, иначе None
+    token = os.urandom(16).hex()
+    if await r.set(f"lock:{name}", token, nx=True, ex=ttl):
+        return token
+    return None
+
+async def release_lock(name, token):
+    await _release_lock_script(keys=[f"lock:{name}"], args=[token])
+
+# Развертывание, для которого лобби уже восстановлены из БД (см. main.on_webhook_startup)
+RESTORED_DEPLOY_KEY = "startup:restored"
+
+async def is_restored(deploy_id):
+    return await r.get(RESTORED_DEPLOY_KEY) == deploy_id
+
+async def mark_restored(deploy_id):
+    await r.set(RESTORED_DEPLOY_KEY, deploy_id)
+
 # Универсальные функции для хранения данных в Redis
 async def set_data(key: str, data: Any, ex: int = None):
     await r.set(key, json.dumps(data), ex=ex)
@@ -101,6 +413,113 @@ async def update_data(key: str, update_dict: dict):
     data.update(update_dict)
     await set_data(key, data)
 
+# Лидерборд: ZSET user_id -> ELO и хэш user_id -> никнейм.
+# Источник правды - SQLite, здесь только зеркало для быстрых топов и рангов
+LEADERBOARD_KEY = "leaderboard"
+LEADERBOARD_NAMES_KEY = "leaderboard:names"
+# Версии для ETag и кэша ответов API (см. http_cache): растут при каждом изменении
+LEADERBOARD_VERSION_KEY = "leaderboard_version"
+PROFILE_VERSIONS_KEY = "profile_versions"
+
+# Эпоха Redis: случайный id, создается при первом чтении. После очистки или потери данных
+# Redis счетчики версий начинаются заново, а эпоха меняется - старые ETag не совпадут
+CACHE_EPOCH_KEY = "cache_epoch"
+
+# KEYS: эпоха, ключ версии. ARGV[1] - эпоха-кандидат, ARGV[2] - поле хэша версий (или "").
+# Ответ: {эпоха, версия} за один round trip
+CACHE_VERSION_SCRIPT = """
+local epoch = redis.call('GET', KEYS[1])
+if not epoch then
+    epoch = ARGV[1]
+    redis.call('SET', KEYS[1], epoch)
+end
+local version
+if ARGV[2] == '' then
+    version = redis.call('GET', KEYS[2])
+else
+    version = redis.call('HGET', KEYS[2], ARGV[2])
+end
+return {epoch, tonumber(version or '0')}
+"""
+
+_cache_version_script = r.register_script(CACHE_VERSION_SCRIPT)
+
+async def get_cache_version(key, field=None):
+    # (эпоха, версия) счетчика key - или поля field хэша key - для ETag и кэша ответов
+    epoch, version = await _cache_version_script(
+        keys=[CACHE_EPOCH_KEY, key],
+        args=[os.urandom(8).hex(), "" if field is None else str(field)]
+    )
+    return epoch, int(version)
+
+async def bump_profile_versions(user_ids):
+    async with r.pipeline(transaction=False) as pipe:
+        for uid in user_ids:
+            pipe.hincrby(PROFILE_VERSIONS_KEY, str(uid), 1)
+        await pipe.execute()
+
+async def update_leaderboard(entries):
+    # entries: [(user_id, nickname, elo), ...]
+    if not entries:
+        return
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.zadd(LEADERBOARD_KEY, {str(uid): elo for uid, _, elo in entries})
+        pipe.hset(LEADERBOARD_NAMES_KEY, mapping={str(uid): nickname or "" for uid, nickname, _ in entries})
+        pipe.incr(LEADERBOARD_VERSION_KEY)
+        await pipe.execute()
+
+async def replace_leaderboard(entries):
+    # Полная пересборка: заполняем временные ключи и атомарно подменяем ими основные
+    tmp_key, tmp_names = f"{LEADERBOARD_KEY}:rebuild", f"{LEADERBOARD_NAMES_KEY}:rebuild"
+    await r.delete(tmp_key, tmp_names)
+    for i in range(0, len(entries), 5000):
+        chunk = entries[i:i + 5000]
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.zadd(tmp_key, {str(uid): elo for uid, _, elo in chunk})
+            pipe.hset(tmp_names, mapping={str(uid): nickname or "" for uid, nickname, _ in chunk})
+            await pipe.execute()
+    async with r.pipeline(transaction=True) as pipe:
+        if entries:
+            pipe.rename(tmp_key, LEADERBOARD_KEY)
+            pipe.rename(tmp_names, LEADERBOARD_NAMES_KEY)
+        else:
+            pipe.delete(LEADERBOARD_KEY, LEADERBOARD_NAMES_KEY)
+        pipe.incr(LEADERBOARD_VERSION_KEY)
+        await pipe.execute()
+
+async def _leaderboard_rows(pairs, first_rank):
+    # pairs: [(user_id, elo), ...] из ZREVRANGE ... WITHSCORES
+    if not pairs:
+        return []
+    names = await r.hmget(LEADERBOARD_NAMES_KEY, [uid for uid, _ in pairs])
+    return [
+        {"rank": first_rank + i, "user_id": int(uid), "nickname": name, "elo": int(elo)}
+        for i, ((uid, elo), name) in enumerate(zip(pairs, names))
+    ]
+
+async def get_leaderboard_top(limit=10):
+    pairs = await r.zrevrange(LEADERBOARD_KEY, 0, limit - 1, withscores=True)
+    return await _leaderboard_rows(pairs, 1)
+
+async def get_leaderboard_rank(user_id):
+    # Место игрока (с 1) и его ELO за один round trip, None если игрока нет в рейтинге
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zrevrank(LEADERBOARD_KEY, str(user_id))
+        pipe.zscore(LEADERBOARD_KEY, str(user_id))
+        rank, elo = await pipe.execute()
+    if rank is None:
+        return None
+    return {"rank": rank + 1, "elo": int(elo)}
+
+async def get_leaderboard_around(user_id, radius=2):
+    # Игроки рядом с пользователем в рейтинге: radius выше и radius ниже
+    rank = await r.zrevrank(LEADERBOARD_KEY, str(user_id))
+    if rank is None:
+        return []
+    start = max(rank - radius, 0)
+    pairs = await r.zrevrange(LEADERBOARD_KEY, start, rank + radius, withscores=True)
+    return await _leaderboard_rows(pairs, start + 1)
+
 # Специфичные функции для поддержки и матчей
 async def set_ticket(ticket_id, data):
     await set_data(f"ticket:{ticket_id}", data, ex=86400) # 24 часа
@@ -123,6 +542,48 @@ async def delete_match(match_id, pending=True):
     prefix = "pending_match" if pending else "active_match"
     await delete_data(f"{prefix}:{match_id}")
 
+# Отложенные события (таймауты подтверждения, банов и пиков).
+# ZSET deadlines: id события -> unix-время срабатывания, хэш deadlines:data: id -> JSON
+DEADLINES_KEY = "deadlines"
+DEADLINES_DATA_KEY = "deadlines:data"
+
+# Забирает наступившие события атомарно: при нескольких репликах каждое сработает один раз.
+# KEYS: ZSET, хэш. ARGV: текущее время, максимум событий. Ответ: плоский список {id, данные, ...}
+CLAIM_DEADLINES_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local result = {}
+for _, id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], id)
+    local data = redis.call('HGET', KEYS[2], id)
+    redis.call('HDEL', KEYS[2], id)
+    if data then
+        table.insert(result, id)
+        table.insert(result, data)
+    end
+end
+return result
+"""
+
+_claim_deadlines_script = r.register_script(CLAIM_DEADLINES_SCRIPT)
+
+async def set_deadline(event_id, fire_at, data):
+    # Повторная постановка того же id переносит срок и заменяет данные
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.zadd(DEADLINES_KEY, {event_id: fire_at})
+        pipe.hset(DEADLINES_DATA_KEY, event_id, json.dumps(data))
+        await pipe.execute()
+
+async def cancel_deadline(event_id):
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.zrem(DEADLINES_KEY, event_id)
+        pipe.hdel(DEADLINES_DATA_KEY, event_id)
+        removed, _ = await pipe.execute()
+    return bool(removed)
+
+async def claim_due_deadlines(now, limit=100):
+    data = await _claim_deadlines_script(keys=[DEADLINES_KEY, DEADLINES_DATA_KEY], args=[now, limit])
+    return [(data[i], json.loads(data[i + 1])) for i in range(0, len(data), 2)]
+
 # Удаляем старые словари и заглушки
 # lobby_players и lobby_viewers больше не нужны как переменные, 
 # так как мы перешли на асинхронные вызовы Redis.
@@ -0,0 +1,28 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+
+# Redis в тестах - fakeredis в памяти: state.py создает клиент при импорте,
+# поэтому подменяем фабрику до первого импорта state
+try:
+    import fakeredis
+    import redis.asyncio
+except ImportError:
+    fakeredis = None
+else:
+    _server = fakeredis.FakeServer()
+    redis.asyncio.from_url = lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=_server, decode_responses=True)
+
+@pytest.fixture
+def redis_state():
+    if fakeredis is None:
+        pytest.skip("fakeredis is not installed")
+    import state
+    asyncio.run(state.r.flushall())
+    return state
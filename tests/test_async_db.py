@@ -0,0 +1,50 @@
+import asyncio
+
+import async_db
+
+PLAYERS = [601, 602, 603, 604]
+
+def test_leaderboard_matches_sqlite_after_settle(redis_state):
+    state = redis_state
+
+    async def run():
+        await async_db.init_db()
+        for uid in PLAYERS:
+            await async_db.add_user(uid, f"g{uid}", f"p{uid}")
+        match_id = await async_db.create_match("2x2", PLAYERS)
+        try:
+            # Параллельные записи не должны оставить в зеркале устаревшее ELO
+            settled, _ = await asyncio.gather(
+                async_db.settle_match(match_id, PLAYERS[:2], PLAYERS[2:], 25),
+                async_db.manual_update_elo(PLAYERS[0], 10)
+            )
+            assert settled
+            mirror = {uid: await state.r.zscore(state.LEADERBOARD_KEY, str(uid)) for uid in PLAYERS}
+            stored = {uid: (await async_db.get_user(uid))[2] for uid in PLAYERS}
+        finally:
+            async_db.shutdown()
+        return mirror, stored
+
+    mirror, stored = asyncio.run(run())
+    assert stored == {601: 1035, 602: 1025, 603: 975, 604: 975}
+    assert mirror == {uid: float(elo) for uid, elo in stored.items()}
+
+def test_settle_only_changes_an_unsettled_match(redis_state):
+    async def run():
+        await async_db.init_db()
+        for uid in (611, 612, 613, 614):
+            await async_db.add_user(uid, f"g{uid}", f"p{uid}")
+        try:
+            match_id = await async_db.create_match("1x1", [611, 612])
+            assert await async_db.settle_match(match_id, [611], [612], 25)
+            # Повторное подтверждение ничего не меняет
+            assert not await async_db.settle_match(match_id, [611], [612], 25)
+
+            cancelled_id = await async_db.create_match("1x1", [613, 614])
+            await async_db.cancel_match(cancelled_id)
+            assert not await async_db.settle_match(cancelled_id, [613], [614], 25)
+            return [(await async_db.get_user(uid))[2:5] for uid in (611, 612, 613, 614)]
+        finally:
+            async_db.shutdown()
+
+    assert asyncio.run(run()) == [(1025, 4, 1), (975, 4, 1), (1000, 4, 0), (1000, 4, 0)]
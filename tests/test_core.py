@@ -0,0 +1,21 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import async_db
+import bans
+import db
+from app import app
+
+def test_banned_user_cannot_enter_lobby_through_api():
+    db.init_db()
+    db.add_user(501, "g501", "banned")
+
+    async def ban():
+        await bans.set_ban_status(501, True)
+        async_db.shutdown()
+
+    asyncio.run(ban())
+    with TestClient(app) as client:
+        response = client.post("/api/lobby/enter", json={"user_id": 501, "mode": "1x1", "lobby_id": 1})
+    assert response.status_code == 403
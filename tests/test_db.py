@@ -0,0 +1,34 @@
+import pytest
+
+import async_db
+import db
+
+@pytest.fixture
+def user_db(tmp_path, monkeypatch):
+    # Отдельная база: страницы считаются от первого и последнего user_id таблицы.
+    # Потоки async_db держат соединения со старой базой - закрываем их вместе с потоками
+    async_db.shutdown()
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "users.db"))
+    db.init_db()
+    for uid in range(1, 26):
+        db.add_user(uid, f"g{uid}", f"p{uid}")
+    yield db
+    async_db.shutdown()
+
+def ids(page):
+    users, has_prev, has_next = page
+    return [u[0] for u in users], has_prev, has_next
+
+def test_users_page_walks_forward_to_the_last_page(user_db):
+    assert ids(db.get_users_page(limit=10)) == (list(range(1, 11)), False, True)
+    assert ids(db.get_users_page(after_id=10, limit=10)) == (list(range(11, 21)), True, True)
+    assert ids(db.get_users_page(after_id=20, limit=10)) == (list(range(21, 26)), True, False)
+
+def test_users_page_walks_back_to_the_first_page(user_db):
+    assert ids(db.get_users_page(before_id=21, limit=10)) == (list(range(11, 21)), True, True)
+    assert ids(db.get_users_page(before_id=11, limit=10)) == (list(range(1, 11)), False, True)
+
+def test_users_page_exact_multiple_has_no_extra_page(user_db):
+    # 25 пользователей, страница 5: последняя страница ровно заполнена
+    assert ids(db.get_users_page(after_id=20, limit=5)) == (list(range(21, 26)), True, False)
+    assert ids(db.get_users_page(before_id=6, limit=5)) == (list(range(1, 6)), False, True)
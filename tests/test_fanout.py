@@ -0,0 +1,69 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.methods import SendMessage
+
+import fanout
+import outbox
+
+METHOD = SendMessage(chat_id=1, text="x")
+
+class FakeBot:
+    # Для каждого чата - очередь исключений, после нее сообщение доставляется
+    def __init__(self, failures):
+        self.failures = {chat_id: list(errors) for chat_id, errors in failures.items()}
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(chat_id)
+        errors = self.failures.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        return SimpleNamespace(message_id=chat_id * 10)
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_RETRY_DELAY", 0)
+
+def test_notify_classifies_failures():
+    bot = FakeBot({
+        2: [TelegramForbiddenError(METHOD, "bot was blocked by the user")],
+        3: [TelegramBadRequest(METHOD, "chat not found")],
+        4: [TelegramRetryAfter(METHOD, "flood", 5)],
+        5: [outbox.OutboxDropped("full")],
+        6: [TelegramNetworkError(METHOD, "timeout")] * (fanout.FANOUT_RETRIES + 1),
+    })
+    messages = {chat_id: "match found" for chat_id in range(1, 7)}
+
+    report = asyncio.run(fanout.notify("test", bot, messages))
+
+    assert report["message_ids"] == {1: 10}
+    assert sorted(report["dead"]) == [2, 3]
+    assert sorted(report["failed"]) == [4, 5, 6]
+    # Временная ошибка сети повторяется, блокировка - нет
+    assert bot.calls.count(6) == fanout.FANOUT_RETRIES + 1
+    assert bot.calls.count(2) == 1
+
+def test_transient_error_is_retried_until_delivered():
+    bot = FakeBot({1: [TelegramServerError(METHOD, "Bad Gateway")]})
+    report = asyncio.run(fanout.notify("test", bot, {1: "hi"}))
+    assert report["message_ids"] == {1: 10}
+    assert report["dead"] == report["failed"] == []
+
+def test_broadcast_treats_unmodified_edit_as_sent():
+    async def edit():
+        raise TelegramBadRequest(METHOD, "Bad Request: message is not modified")
+
+    report = asyncio.run(fanout.broadcast("test", {1: edit}))
+    assert report["sent"] == 1 and report["dead"] == []
+
+def test_programming_error_is_not_hidden():
+    async def broken():
+        raise KeyError("nickname")
+
+    with pytest.raises(KeyError):
+        asyncio.run(fanout.broadcast("test", {1: broken}))
@@ -0,0 +1,57 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import async_db
+import db
+from app import app
+
+def test_user_etag_round_trip(redis_state):
+    state = redis_state
+    db.init_db()
+    db.add_user(701, "g701", "cached")
+
+    def run(coro):
+        async def call():
+            try:
+                return await coro
+            finally:
+                async_db.shutdown()
+        return asyncio.run(call())
+
+    with TestClient(app) as client:
+        first = client.get("/api/user/701")
+        etag = first.headers["etag"]
+        assert first.status_code == 200
+        assert first.json()["nickname"] == "cached"
+
+        # Тот же ETag - 304 без тела
+        cached = client.get("/api/user/701", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        assert cached.content == b""
+        assert cached.headers["etag"] == etag
+
+        # Изменение ELO поднимает версию профиля: старый ETag больше не совпадает
+        run(async_db.manual_update_elo(701, 15))
+        changed = client.get("/api/user/701", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.json()["elo"] == 1015
+        assert changed.headers["etag"] != etag
+
+        # После очистки Redis счетчики начинаются заново, но эпоха другая
+        etag = changed.headers["etag"]
+        run(state.r.flushall())
+        after_flush = client.get("/api/user/701", headers={"If-None-Match": etag})
+        assert after_flush.status_code == 200
+        assert after_flush.headers["etag"] != etag
+
+def test_leaderboard_etag_changes_with_leaderboard(redis_state):
+    with TestClient(app) as client:
+        first = client.get("/api/leaderboard")
+        etag = first.headers["etag"]
+        assert client.get("/api/leaderboard", headers={"If-None-Match": etag}).status_code == 304
+
+        asyncio.run(redis_state.update_leaderboard([(702, "top", 3000)]))
+        changed = client.get("/api/leaderboard", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.json()[0]["nickname"] == "top"
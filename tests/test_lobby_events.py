@@ -0,0 +1,43 @@
+import asyncio
+
+import lobby_events
+import refresh
+
+async def _wait_subscribed(state):
+    for _ in range(100):
+        if dict(await state.r.pubsub_numsub(state.LOBBY_EVENTS_CHANNEL))[state.LOBBY_EVENTS_CHANNEL]:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("listener did not subscribe")
+
+def test_listener_runs_only_while_streams_are_open(redis_state, monkeypatch):
+    state = redis_state
+    monkeypatch.setattr(refresh, "LOBBY_REFRESH_WINDOW", 0.01)
+
+    async def run():
+        await state.clear_lobbies()
+        subscription = lobby_events.subscribe()
+        listener = lobby_events._listener
+        await _wait_subscribed(state)
+
+        await state.join_lobby("1x1", 4, 9, {"nickname": "a"})
+        version, snapshot = await subscription.wait(2)
+        assert version == await state.get_lobby_version()
+        assert snapshot["1x1"][3]["roster"] == {"9": {"nickname": "a"}}
+
+        # Последний поток закрыт - слушатель остановлен, снимки не собираются
+        lobby_events.unsubscribe(subscription)
+        await asyncio.gather(listener, return_exceptions=True)
+        assert listener.cancelled() and lobby_events._listener is None
+        snapshots = lobby_events.stats["snapshots"]
+        await state.remove_player_from_lobby("1x1", 4, 9)
+        await asyncio.sleep(0.1)
+        assert lobby_events.stats["snapshots"] == snapshots
+
+        # Новый поток снова запускает слушателя
+        subscription = lobby_events.subscribe()
+        assert not lobby_events._listener.done()
+        await lobby_events.close()
+        assert subscription.closed and lobby_events._listener is None
+
+    asyncio.run(run())
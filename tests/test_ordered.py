@@ -0,0 +1,104 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import ordered
+
+class Form(StatesGroup):
+    a = State()
+    b = State()
+
+def make_update(update_id, user_id, text):
+    user = types.User(id=user_id, is_bot=False, first_name="test")
+    return types.Update(
+        update_id=update_id,
+        message=types.Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=types.Chat(id=user_id, type="private"),
+            from_user=user,
+            text=text
+        )
+    )
+
+def test_queued_update_sees_state_set_by_previous_one():
+    seen = []
+
+    async def run():
+        dp = Dispatcher(storage=MemoryStorage())
+        ordered.setup(dp)
+
+        @dp.message(Form.a, F.text)
+        async def step_a(message: types.Message, state: FSMContext):
+            # Медленный обработчик: второе сообщение уже в очереди шарда
+            await asyncio.sleep(0.05)
+            seen.append(("a", message.text))
+            await state.set_state(Form.b)
+
+        @dp.message(Form.b, F.text)
+        async def step_b(message: types.Message, state: FSMContext):
+            seen.append(("b", message.text))
+            await state.clear()
+
+        bot = Bot(token="42:TEST")
+        context = dp.fsm.get_context(bot=bot, chat_id=7, user_id=7)
+        await context.set_state(Form.a)
+        try:
+            await asyncio.gather(
+                dp.feed_update(bot, make_update(1, 7, "gameid")),
+                dp.feed_update(bot, make_update(2, 7, "nick"))
+            )
+        finally:
+            await ordered.stop()
+            await bot.session.close()
+
+    asyncio.run(run())
+    assert seen == [("a", "gameid"), ("b", "nick")]
+
+def test_fsm_lock_serializes_one_user_across_workers(redis_state):
+    from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+
+    events = []
+
+    async def run():
+        storage = RedisStorage(redis=redis_state.r, key_builder=DefaultKeyBuilder(with_bot_id=True))
+        # Два диспетчера с общим Redis - как два воркера за webhook
+        workers = []
+        for _ in range(2):
+            dp = Dispatcher(storage=storage, events_isolation=storage.create_isolation())
+            ordered.setup(dp)
+
+            @dp.message(F.text)
+            async def handle(message: types.Message, state: FSMContext):
+                events.append(("start", message.text))
+                await asyncio.sleep(0.05)
+                events.append(("end", message.text))
+
+            workers.append(dp)
+
+        bot = Bot(token="42:TEST")
+        try:
+            await asyncio.gather(
+                workers[0].feed_update(bot, make_update(1, 7, "first")),
+                workers[1].feed_update(bot, make_update(2, 7, "second"))
+            )
+        finally:
+            await ordered.stop()
+            await bot.session.close()
+
+    asyncio.run(run())
+    # Обработчик второго воркера начинается только после конца первого
+    assert [kind for kind, _ in events] == ["start", "end", "start", "end"]
+    assert events[0][1] == events[1][1]
+
+def test_setup_fails_loudly_without_fsm_middleware():
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.update.outer_middleware._middlewares.clear()
+    with pytest.raises(RuntimeError):
+        ordered.setup(dp)
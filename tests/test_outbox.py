@@ -0,0 +1,107 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import outbox
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class FakeBot:
+    # Отвечает по сценарию: исключение из очереди failures или id сообщения
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.sent = []
+
+    async def send(self, chat_id, text):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((chat_id, text))
+        return len(self.sent)
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    # Подменяем только часы outbox: часы event loop должны идти как обычно
+    monkeypatch.setattr(outbox, "time", SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(outbox, "_global_buckets", {})
+    monkeypatch.setattr(outbox, "_chat_buckets", {})
+    return fake
+
+def test_bucket_refills_at_rate_up_to_capacity(clock):
+    bucket = outbox.TokenBucket(rate=2, capacity=2)
+    assert bucket.delay(clock.now) == 0
+    bucket.take()
+    bucket.take()
+    assert bucket.delay(clock.now) == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.delay(clock.now) == 0
+    clock.now += 10
+    bucket.delay(clock.now)
+    assert bucket.tokens == 2
+
+def test_bucket_block_delays_until_retry_after(clock):
+    bucket = outbox.TokenBucket(rate=10, capacity=10)
+    bucket.block(5)
+    assert bucket.delay(clock.now) == pytest.approx(5)
+    clock.now += 5
+    assert bucket.delay(clock.now) == 0
+
+def test_global_rate_is_split_between_processes(clock, monkeypatch):
+    monkeypatch.setattr(outbox, "_processes", 4)
+    assert outbox._global_bucket(1).rate == pytest.approx(outbox.GLOBAL_RATE / 4)
+
+def test_retry_after_defers_job_and_then_delivers(clock, monkeypatch):
+    retry = TelegramRetryAfter(SendMessage(chat_id=5, text="x"), "Flood control", retry_after=7)
+    bot = FakeBot(failures=[retry])
+    waits = []
+    defer = outbox._defer
+
+    def fast_defer(job, wait):
+        # Запоминаем паузу и сразу "проматываем" время
+        waits.append(wait)
+        clock.now += wait
+        defer(job, 0)
+
+    monkeypatch.setattr(outbox, "_defer", fast_defer)
+
+    async def run():
+        outbox.start()
+        try:
+            return await asyncio.wait_for(outbox.submit(lambda: bot.send(5, "hello"), 5, bot_id=1), 5)
+        finally:
+            await outbox.stop()
+
+    retried = outbox.stats["retried"]
+    assert asyncio.run(run()) == 1
+    assert waits == [7]
+    assert bot.sent == [(5, "hello")]
+    assert outbox.stats["retried"] == retried + 1
+
+def test_full_queue_drops_only_lobby_updates(monkeypatch):
+    monkeypatch.setattr(outbox, "MAX_QUEUE", 1)
+
+    async def run():
+        # Очередь без воркеров: задания копятся
+        monkeypatch.setattr(outbox, "_queue", asyncio.PriorityQueue())
+        bot = FakeBot()
+        first = asyncio.create_task(outbox.submit(lambda: bot.send(1, "a"), 1, level=outbox.PRIORITY_NORMAL))
+        await asyncio.sleep(0)
+        with pytest.raises(outbox.OutboxDropped):
+            await outbox.submit(lambda: bot.send(2, "b"), 2, level=outbox.PRIORITY_LOBBY)
+        match = asyncio.create_task(outbox.submit(lambda: bot.send(3, "c"), 3, level=outbox.PRIORITY_MATCH))
+        await asyncio.sleep(0)
+        assert outbox.depth() == 2
+        first.cancel()
+        match.cancel()
+        await asyncio.gather(first, match, return_exceptions=True)
+
+    asyncio.run(run())
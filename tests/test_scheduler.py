@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import scheduler
+
+def test_two_pollers_claim_each_deadline_once(redis_state):
+    state = redis_state
+
+    async def run():
+        now = time.time()
+        for i in range(50):
+            await state.set_deadline(f"accept:{i}", now - 1, {"kind": "accept", "args": [i]})
+        await state.set_deadline("accept:later", now + 60, {"kind": "accept", "args": ["later"]})
+
+        async def poll():
+            claimed = []
+            while batch := await state.claim_due_deadlines(now, limit=7):
+                claimed.extend(event_id for event_id, _ in batch)
+                await asyncio.sleep(0)
+            return claimed
+
+        first, second = await asyncio.gather(poll(), poll())
+        return first, second, await state.r.zrange(state.DEADLINES_KEY, 0, -1)
+
+    first, second, left = asyncio.run(run())
+    assert not set(first) & set(second)
+    assert sorted(first + second) == sorted(f"accept:{i}" for i in range(50))
+    assert left == ["accept:later"]
+
+def test_scheduler_fires_once_across_runners(redis_state, monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(scheduler, "SCHEDULER_BATCH", 3)
+    fired = []
+
+    async def handler(match_id):
+        fired.append(match_id)
+
+    async def run():
+        scheduler.register("test_timeout", handler)
+        for match_id in range(10):
+            await scheduler.schedule("test_timeout", match_id, 0, match_id)
+        # Перенос и отмена до срабатывания
+        await scheduler.schedule("test_timeout", 3, 60, 3)
+        await scheduler.cancel("test_timeout", 4)
+
+        runners = [asyncio.create_task(scheduler.run()) for _ in range(2)]
+        await asyncio.sleep(0.2)
+        for task in runners:
+            task.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+
+    asyncio.run(run())
+    assert sorted(fired) == [0, 1, 2, 5, 6, 7, 8, 9]
@@ -0,0 +1,46 @@
+import asyncio
+
+def test_membership_change_bumps_version_atomically(redis_state):
+    state = redis_state
+
+    async def run():
+        await state.clear_lobbies()
+        version = await state.get_lobby_version()
+
+        await state.join_lobby("1x1", 3, 7, {"nickname": "a"})
+        after_join, changes = await state.get_lobby_changes(version)
+        assert after_join > version
+        assert [(c["mode"], c["id"], c["players"]) for c in changes] == [("1x1", 3, 1)]
+
+        # Переход в другое лобби отмечает оба лобби
+        await state.join_lobby("2x2", 1, 7, {"nickname": "a"})
+        _, changes = await state.get_lobby_changes(after_join)
+        assert {(c["mode"], c["id"], c["players"]) for c in changes} == {("1x1", 3, 0), ("2x2", 1, 1)}
+
+        version = await state.get_lobby_version()
+        await state.remove_player_from_lobby("2x2", 1, 7)
+        _, changes = await state.get_lobby_changes(version)
+        assert [(c["mode"], c["id"], c["players"]) for c in changes] == [("2x2", 1, 0)]
+
+        # Выход того, кого нет в лобби, версию не меняет
+        version = await state.get_lobby_version()
+        await state.remove_player_from_lobby("2x2", 1, 7)
+        assert await state.get_lobby_changes(version) == (version, [])
+
+    asyncio.run(run())
+
+def test_take_and_restore_are_versioned(redis_state):
+    state = redis_state
+
+    async def run():
+        await state.set_lobby_players("5x5", 2, {"1": {"nickname": "a"}, "2": {"nickname": "b"}})
+        version = await state.get_lobby_version()
+        assert await state.get_user_current_lobby(2) == {"mode": "5x5", "id": 2}
+
+        taken = await state.take_lobby_players("5x5", 2)
+        assert set(taken) == {"1", "2"}
+        _, changes = await state.get_lobby_changes(version)
+        assert [(c["mode"], c["id"], c["players"]) for c in changes] == [("5x5", 2, 0)]
+        assert await state.get_user_current_lobby(2) is None
+
+    asyncio.run(run())
@@ -0,0 +1,29 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import webhook
+
+class FakeDispatcher:
+    def __init__(self):
+        self.updates = []
+
+    async def feed_raw_update(self, bot, data):
+        self.updates.append(data["update_id"])
+
+def test_update_requires_matching_secret():
+    app = FastAPI()
+    dispatcher = FakeDispatcher()
+    webhook.setup(app, object(), dispatcher, "/webhook/1", "s3cret")
+    with TestClient(app) as client:
+        assert client.post("/webhook/1", json={"update_id": 1}).status_code == 403
+        headers = {webhook.SECRET_HEADER: "wrong"}
+        assert client.post("/webhook/1", json={"update_id": 2}, headers=headers).status_code == 403
+        headers = {webhook.SECRET_HEADER: "s3cret"}
+        assert client.post("/webhook/1", json={"update_id": 3}, headers=headers).status_code == 200
+        client.portal.call(webhook.drain)
+    assert dispatcher.updates == [3]
+
+def test_setup_refuses_empty_secret():
+    with pytest.raises(ValueError):
+        webhook.setup(FastAPI(), object(), FakeDispatcher(), "/webhook/1", None)
@@ -0,0 +1,90 @@
+"""Прием обновлений Telegram через webhook на FastAPI-приложении из app.py.
+
+Включается переменной WEBHOOK_URL (см. main.py). Для каждого бота
+монтируется POST-маршрут; запрос проверяется по секретному заголовку,
+ответ Telegram отдается сразу, а обновление обрабатывается диспетчером в
+фоне. Секрет (WEBHOOK_SECRET) обязателен: id бота публичен, и без него
+маршрут принял бы поддельные обновления. Одновременно обрабатывается не
+больше WEBHOOK_CONCURRENCY обновлений на процесс; если в работе уже
+WEBHOOK_MAX_PENDING, маршрут отвечает 503 и Telegram доставит обновление
+повторно. Нагрузку можно делить между несколькими воркерами uvicorn:
+состояние (лобби, FSM, таймеры) лежит в Redis.
+"""
+import asyncio
+import hmac
+import logging
+import os
+
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 32))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", 1000))
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_semaphore = None
+_tasks = set()
+
+stats = {
+    "received": 0,
+    "processed": 0,
+    "failed": 0,
+    "rejected": 0,
+    "max_pending": 0,
+}
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+    return _semaphore
+
+async def _process(dispatcher, bot, data):
+    async with _get_semaphore():
+        try:
+            await dispatcher.feed_raw_update(bot, data)
+            stats["processed"] += 1
+        except Exception as e:
+            stats["failed"] += 1
+            logging.error(f"Failed to process update {data.get('update_id')}: {e}")
+
+def setup(app, bot, dispatcher, path, secret):
+    """Монтирует на app маршрут POST path для обновлений бота bot."""
+    if not secret:
+        raise ValueError("Webhook secret is required")
+
+    async def receive_update(request: Request):
+        received = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(received.encode(), secret.encode()):
+            raise HTTPException(status_code=403, detail="Forbidden")
+        if len(_tasks) >= WEBHOOK_MAX_PENDING:
+            stats["rejected"] += 1
+            return JSONResponse(status_code=503, content={"ok": False})
+
+        data = await request.json()
+        stats["received"] += 1
+        task = asyncio.create_task(_process(dispatcher, bot, data))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+        stats["max_pending"] = max(stats["max_pending"], len(_tasks))
+        return {"ok": True}
+
+    app.add_api_route(path, receive_update, methods=["POST"], include_in_schema=False)
+
+async def set_webhook(bot, dispatcher, url, secret):
+    await bot.set_webhook(
+        url,
+        secret_token=secret,
+        allowed_updates=dispatcher.resolve_used_update_types()
+    )
+    logging.info(f"Webhook для бота {bot.id} установлен: {url}")
+
+async def drain():
+    # Дожидаемся уже принятых обновлений перед остановкой
+    if _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
+
+def get_stats():
+    result = dict(stats)
+    result["pending"] = len(_tasks)
+    return result